@@ -0,0 +1,139 @@
+"""Throughput benchmark of the search modes, on the simulated rig.
+
+Usage: python benchmark.py [grid | random | algo | steady | all] [OUTFILE] [seed=N] [scale=S]
+
+Every mode is run on a fresh `simulator.SimRig` with a fixed seed, and
+the results are appended to OUTFILE (`benchmark.json` by default) as one
+JSON object per line, so that runs on different branches can be compared.
+
+With scale < 1 the simulated hardware is faster than the real one, but
+the code's own sleeps aren't, so the rates are only representative
+at the default scale=1.
+"""
+from __future__ import print_function, division
+import json
+import random
+import subprocess
+import sys
+import time
+import numpy as np
+
+import ga
+import main
+from simulator import SimRig
+
+
+MODES   = ["grid", "random", "algo", "steady"]
+OUTFILE = "benchmark.json"
+
+# hardware-bound phases of `ga.timing`; the rest of the time is Python-side
+HARDWARE_PHASES = ["moving", "reset", "normal", "justright", "evcg_busy"]
+
+
+def run_grid(vcg, table):
+    main.grid_search(vcg, table, spatial_granul=3, int_granul=3, offset_ms=[0.368, 0.370, 0.372])
+
+def run_random(vcg, table):
+    main.random_search(vcg, table, 30)
+
+def run_algo(vcg, table):
+    main.N_ITERS = 3
+    main.POPSIZE = 10
+    main.algo_search(vcg, table)
+
+def run_steady(vcg, table):
+    main.steady_state_search(vcg, table, 30, popsize=10)
+
+RUNNERS = {"grid": run_grid, "random": run_random, "algo": run_algo, "steady": run_steady}
+
+
+def reset_state():
+    """Forgets everything the previous run left in the module globals"""
+    ga.cache.clear()
+    ga.timing.reset()
+    ga.reset_stats["skipped"] = ga.reset_stats["streak"] = 0
+    ga.reset_stats["previous"] = None
+    for outcomes in (ga.reset_stats["after_normal_reset"], ga.reset_stats["after_normal_skipped"]):
+        for outcome in outcomes:
+            outcomes[outcome] = 0
+
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"]).decode().strip()
+    except Exception:
+        return None
+
+
+def benchmark(mode, seed=0, time_scale=1.0):
+    """Runs `mode` on a simulated rig, returns the results as a dict"""
+    random.seed(seed)
+    np.random.seed(seed)
+    reset_state()
+    main.JOURNALFILE = None
+
+    rig = SimRig(seed=seed, time_scale=time_scale)
+    table = rig.make_table()
+    vcg = rig.make_vcg()
+
+    t0 = time.time()
+    RUNNERS[mode](vcg, table)
+    wall = time.time() - t0
+
+    units = list(ga.cache)
+    measurements = [m for u in units for m in (u.measurements or [])]
+    hours = wall / 3600
+    hardware = sum(ga.timing[phase] for phase in HARDWARE_PHASES)
+
+    return {
+        "mode"       : mode,
+        "seed"       : seed,
+        "time_scale" : time_scale,
+        "revision"   : revision(),
+        "date"       : time.strftime("%Y-%m-%d %H:%M:%S"),
+        "wall_s"     : wall,
+        "points"     : len(units),
+        "shots"      : len(measurements),
+        "points_per_hour"          : len(units) / hours,
+        "shots_per_hour"           : len(measurements) / hours,
+        "justright_points_per_hour": sum(u.type == "JUSTRIGHT" for u in units) / hours,
+        "justright_shots_per_hour" : measurements.count("JUSTRIGHT") / hours,
+        "overhead_per_point_s"     : (wall - hardware) / max(1, len(units)),
+        "moving_per_point_s"       : ga.timing["moving"] / max(1, len(units)),
+        "phases_s"   : dict(ga.timing.items()),
+        "phase_stats": ga.timing.summary(),
+        "types"      : dict((t, sum(u.type == t for u in units)) for t in ("NORMAL", "RESET", "CHANGING", "JUSTRIGHT")),
+        "skipped_uploads" : vcg.skipped_uploads,
+        "cache_hits"      : ga.cache.hits,
+        "cache_misses"    : ga.cache.misses,
+    }
+
+
+def fatal_usage():
+    print("Usage: python {:s} [grid | random | algo | steady | all] [OUTFILE] [seed=N] [scale=S]".format(sys.argv[0]),
+          file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    if not (len(sys.argv) >= 2 and sys.argv[1].lower() in MODES + ["all"]):
+        fatal_usage()
+
+    modes = MODES if sys.argv[1].lower() == "all" else [sys.argv[1].lower()]
+    outfile = OUTFILE
+    seed = 0
+    time_scale = 1.0
+    for arg in sys.argv[2:]:
+        if arg.startswith("seed="):    seed = int(arg[5:])
+        elif arg.startswith("scale="): time_scale = float(arg[6:])
+        else:                          outfile = arg
+
+    with open(outfile, "a") as f:
+        for mode in modes:
+            result = benchmark(mode, seed, time_scale)
+            print(json.dumps(result, sort_keys=True), file=f)
+            print("{:>6s}: {:.0f} points/h, {:.0f} shots/h, {:.1f} JUSTRIGHT points/h, "
+                  "{:.4f}s overhead and {:.4f}s moving per point".format(mode, result["points_per_hour"],
+                  result["shots_per_hour"], result["justright_points_per_hour"], result["overhead_per_point_s"],
+                  result["moving_per_point_s"]))
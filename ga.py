@@ -1,13 +1,14 @@
 import numpy as np
 import random
-import time
 import copy
-from collections import OrderedDict
 from binascii import unhexlify
-from vcg import VCG_ReadTimeout, VCG_BusyTimeout
+from vcg import VCG_ReadTimeout, VCG_BusyTimeout, AMPLITUDE_LO, AMPLITUDE_HI, AMPLITUDE_STEP
 from tsp import find_shortest_hamilton_path_XYZ
 from io_functions import read_cache_from_file
-from unit import Unit, OFFSET_MIN, OFFSET_MAX, OFFSET_RANGE
+from unit import OFFSET_MIN, OFFSET_MAX, OFFSET_RANGE
+from population import Population
+from instrumentation import PhaseTimer, clock
+from unit_cache import UnitCache
 
 P_MUT = 0.05
 CUBE_SIZE = 0.1     # cutoff distance for "close"
@@ -33,22 +34,98 @@ RESPONSE_CORRECT = unhexlify(
 
 XY_RESOLUTION = 500
 
-
-cache = OrderedDict()
-
-time_while = {
-    "moving"    : 0.0,    # total time spent moving
-    "path"      : 0.0,    # total time spent optimizing path
-    "reset"     : 0.0,    # total time spent on RESET measurements
-    "normal"    : 0.0,    # total time spent on NORMAL measurements
-    "justright" : 0.0,    # total time spent on JUSTRIGHT measurements
-    "evcg_busy" : 0.0,    # total time spent on evcg_busy interrupts
+# Likewise, the glitcher sets the amplitude in steps of AMPLITUDE_STEP,
+#  and the offset is already an integer number of its clock ticks.
+#  The cache treats units within the same step as the same unit.
+INTENSITY_RESOLUTION = int(round((AMPLITUDE_HI - AMPLITUDE_LO) / AMPLITUDE_STEP))
+OFFSET_RESOLUTION = 1
+
+# Wall-clock budget for path optimization, passed on to
+#  `find_shortest_hamilton_path_XYZ`: `None` stops at the first local
+#  optimum, a number is seconds, and a function maps the greedy path
+#  length to seconds.
+PATH_TIME_BUDGET = None
+
+# Shots of the same intensity are glitched in batches of up to
+#  BATCH_PATTERNS patterns (and at most `vcg.n_patterns`), arming the
+#  VCG only once per batch; 1 glitches every shot on its own, with
+#  `VCG.glitch`. Batching is off until it's confirmed on the hardware.
+BATCH_PATTERNS = 1
+
+# With conditional resets, the board is only reset after RESET and
+#  JUSTRIGHT shots, after a stuck VCG, or once every RESET_EVERY clean
+#  (NORMAL) shots in a row, instead of after every shot.
+CONDITIONAL_RESET = False
+RESET_EVERY = 10
+
+# A board that doesn't come up after a reset (see `VCG.reset`) is reset
+#  again, up to RESET_RETRIES times in all; if it still isn't ready, the
+#  next shot finds it silent and counts as a RESET.
+RESET_RETRIES = 3
+
+# With early stopping, a unit's repeated measurements stop as soon as
+#  its class is known with EARLY_STOP_CONFIDENCE, given what the cache
+#  says about its neighbourhood (but never before MIN_MEASUREMENTS).
+EARLY_STOPPING = False
+EARLY_STOP_CONFIDENCE = 0.95
+MIN_MEASUREMENTS = 2
+
+# With screening, `evaluate_batch` first measures every new unit once;
+#  only units that weren't NORMAL, or whose neighbourhood makes them likely
+#  to be CHANGING (more than SCREEN_MAX_CHANGING), get the full measurement
+#  in a second tour.
+SCREENING = False
+SCREEN_MAX_CHANGING = 0.5
+
+# With a surrogate, `selection_surrogate` breeds SURROGATE_POOL times as
+#  many children as it keeps, and keeps those a `surrogate.Surrogate` fit
+#  on the cache scores best (SURROGATE_EXPLORATION weighs the uncertainty).
+SURROGATE = False
+SURROGATE_POOL = 20
+SURROGATE_EXPLORATION = 1.0
+
+# With travel-aware selection, `selection_travel_aware` breeds TRAVEL_POOL
+#  times as many children as it keeps, and builds the batch as a chain
+#  from the table's position, trading the children's promise (in fitness)
+#  against the distance from the previous one (TRAVEL_WEIGHT fitness
+#  points per chip width, along the longest axis).
+TRAVEL_AWARE = False
+TRAVEL_POOL = 5
+TRAVEL_WEIGHT = 5.0
+
+
+cache = UnitCache(XY_RESOLUTION, INTENSITY_RESOLUTION, OFFSET_RESOLUTION, cell_size=CUBE_SIZE)
+
+# Durations of the phases of a scan; `timing[phase]` is the total time.
+#  Shots are timed one by one, including the board reset that follows them
+#  (which is also timed on its own, as "boardreset").
+timing = PhaseTimer([
+    "moving",       # waiting for the table to arrive
+    "path",         # optimizing the path
+    "reset",        # RESET measurements
+    "normal",       # NORMAL measurements
+    "justright",    # JUSTRIGHT measurements
+    "evcg_busy",    # evcg_busy interrupts, and the reset that follows
+    "boardreset",   # resetting the board after a shot
+    "surrogate",    # choosing the candidates with the surrogate
+])
+
+# Outcomes of the shots that follow a NORMAL shot, split by whether the
+#  board was reset in between (the resets forced every RESET_EVERY shots,
+#  or all of them without conditional resets, are the control) or not;
+#  if skipping resets is safe, the distributions match.
+reset_stats = {
+    "skipped"  : 0,       # number of resets skipped
+    "streak"   : 0,       # clean shots since the last reset
+    "previous" : None,    # the bucket of the next shot, if the last one was NORMAL
+    "after_normal_reset"   : {"NORMAL": 0, "RESET": 0, "JUSTRIGHT": 0},
+    "after_normal_skipped" : {"NORMAL": 0, "RESET": 0, "JUSTRIGHT": 0},
 }
 
 
 
 def generate_population(N):
-    return [Unit() for i in range(N)]
+    return Population.random(N)
 
 
 def mutate_unit(solution, p_mut, Q=0.50):
@@ -64,120 +141,374 @@ def mutate_unit(solution, p_mut, Q=0.50):
         solution.offset = new_offs
 
 
-def crossover(parent1, parent2):
-    child = Unit()
-    child.x           = random.random()*(parent1.x - parent2.x) + parent2.x
-    child.y           = random.random()*(parent1.y - parent2.y) + parent2.y
-    child.intensity   = random.random()*(parent1.intensity - parent2.intensity) + parent2.intensity
-    o1 = min(parent1.offset, parent2.offset)
-    o2 = max(parent1.offset, parent2.offset)
-    child.offset      = random.choice(range(o1, o2+1))
-    r1 = min(parent1.repetitions, parent2.repetitions)
-    r2 = max(parent1.repetitions, parent2.repetitions)
-    child.repetitions = random.choice(range(r1, r2+1))
-    return child
+def selection_roulette(population, elite_size=4, p_mut=P_MUT):
+    """Roulette selection with elitism, on an evaluated `Population`"""
+    N = len(population)
+
+    parents1, parents2 = population.select_roulette(N - elite_size)
+    children = population.crossover(parents1, parents2)
+    children.mutate(p_mut)
+
+    return Population.concatenate([children, population[population.elite(elite_size)]])
 
 
-def selection_roulette(population, elite_size=4, mutate=mutate_unit):
-    """Roulette selection with elitism"""
+def selection_surrogate(population, surrogate, elite_size=4, pool=SURROGATE_POOL, p_mut=P_MUT):
+    """Like `selection_roulette`, but out of `pool` times as many children,
+    keeps the uncached ones that the `surrogate` scores best"""
     N = len(population)
-    newpop = []
 
-    fits = np.array([float(u.fitness) for u in population])
-    if fits.min()<0:
-        fits -= fits.min()
-    fits /= fits.sum()
+    with timing.phase("surrogate"):
+        parents1, parents2 = population.select_roulette(pool*(N - elite_size))
+        children = population.crossover(parents1, parents2)
+        children.mutate(p_mut)
+
+        surrogate.update(cache)
+        ranking = np.argsort(-surrogate.score(children), kind="mergesort")
+
+        # the best child of every setup that isn't cached yet ...
+        ids, cached = setup_ids(children)
+        _, firsts = np.unique(ids[ranking], return_index=True)
+        fresh = np.zeros(len(children), dtype=bool)
+        fresh[ranking[firsts]] = True
+        fresh &= ~cached[ids]
+        best = ranking[fresh[ranking]][:N - elite_size]
+
+        # ... and if there aren't enough, the best of the others
+        taken = np.zeros(len(children), dtype=bool)
+        taken[best] = True
+        best = np.concatenate((best, ranking[~taken[ranking]][:N - elite_size - len(best)]))
 
-    parents1 = np.random.choice(population, size=N-elite_size, p=fits)
-    parents2 = np.random.choice(population, size=N-elite_size, p=fits)
-    for par1, par2 in zip(parents1, parents2):
-        child = crossover(par1, par2)
-        mutate(child, P_MUT)
-        newpop += [child]
+    return Population.concatenate([children[best], population[population.elite(elite_size)]])
 
-    newpop += sorted(population, reverse=True)[:elite_size]
 
-    return newpop
+def setup_ids(population):
+    """Numbers the distinct physical setups (cache keys) of a `Population`.
+    Returns the setup of each solution, and whether each setup is cached."""
+    unique, ids = np.unique(cache.keys_of(population), axis=0, return_inverse=True)
+    cached = np.array([tuple(key) in cache.index for key in unique.tolist()], dtype=bool)
+    return ids.ravel(), cached
 
 
-def evaluate_batch(vcg, table, population):
+def selection_travel_aware(population, start=(0.0, 0.0), elite_size=4, pool=TRAVEL_POOL,
+                           travel_weight=TRAVEL_WEIGHT, surrogate=None, p_mut=P_MUT):
+    """Like `selection_roulette`, but the children are picked so that the
+    batch makes a short tour from `start` (the table's (x, y) position).
+
+    Out of `pool` times as many children, the next one picked is the
+    uncached one with the best promise minus `travel_weight` times its
+    distance from the previous one. A child's promise is its `surrogate`
+    score if given, else its parents' mean fitness.
+    """
+    N = len(population)
+
+    parents1, parents2 = population.select_roulette(pool*(N - elite_size))
+    children = population.crossover(parents1, parents2)
+    children.mutate(p_mut)
+
+    if surrogate:
+        with timing.phase("surrogate"):
+            surrogate.update(cache)
+            promise = surrogate.score(children)
+    else:
+        promise = (population.fitness[parents1] + population.fitness[parents2]) / 2
+
+    ids, cached = setup_ids(children)
+    available = ~cached[ids]
+    taken = np.zeros(len(children), dtype=bool)
+    xy = np.column_stack((children.x, children.y))
+    position = np.array(start, dtype=float)
+
+    chosen = []
+    while len(chosen) < N - elite_size:
+        value = np.where(available, promise - travel_weight*np.abs(xy - position).max(axis=1), -np.inf)
+        i = int(np.argmax(value))
+        if not available[i]:          # all cached: take the best remaining ones
+            ranking = np.argsort(-promise, kind="mergesort")
+            chosen += ranking[~taken[ranking]][:N - elite_size - len(chosen)].tolist()
+            break
+        chosen.append(i)
+        taken[i] = True
+        available &= ids != ids[i]
+        position = xy[i]
+
+    return Population.concatenate([children[np.array(chosen, dtype=int)], population[population.elite(elite_size)]])
+
+
+def replace_worst(population, unit, size):
+    """Steady-state insertion of an evaluated `unit` into the `Population`:
+    it's added while there are fewer than `size` solutions, and then
+    replaces the worst one, if it's at least as good."""
+    if len(population) < size:
+        return Population.concatenate([population, Population.from_units([unit])])
+    worst = int(np.argmin(population.fitness))
+    if unit.fitness >= population.fitness[worst]:
+        population.set_unit(worst, unit)
+    return population
+
+
+def evaluate_batch(vcg, table, population, path_budget=PATH_TIME_BUDGET, screening=None):
+    """Evaluates the uncached units of the population along a planned path.
+
+    If `screening` (by default, if SCREENING), every unit is first measured
+    once, and `needs_full_measurement` units are then measured fully
+    along a second path.
+    """
+    if screening is None:
+        screening = SCREENING
+
+    uncached = uncached_units(population)
+
+    if uncached and not screening:
+        for unit in plan_path(table, uncached, path_budget):
+            evaluate_unit(vcg, table, unit)
+    elif uncached:
+        for unit in plan_path(table, uncached, path_budget):
+            evaluate_unit(vcg, table, unit, num_measurements=1, adaptive=False)
+
+        promising = [u for u in uncached if needs_full_measurement(u)]
+        if promising:
+            for unit in plan_path(table, promising, path_budget):
+                evaluate_unit(vcg, table, unit, resume=True)
+
+    for unit in population:
+        unit.fitness = cache[unit]
+    return [u.fitness for u in population]
 
-    uncached = [u for u in population if u not in cache]
-    if not uncached:
-        return [u.fitness for u in population]
 
+def uncached_units(population):
+    """Returns the units of `population` that need to be evaluated:
+    one per physical setup that isn't in the cache yet.
+    The others count as cache hits."""
+    seen = set()
+    uncached = []
+    for u in population:
+        key = cache.key(u)
+        if key in seen:
+            cache.hits += 1
+            continue
+        seen.add(key)
+        if cache.lookup(u) is None:
+            uncached.append(u)
+    return uncached
+
+
+def plan_path(table, units, path_budget=PATH_TIME_BUDGET):
+    """Returns the units in the order they should be visited"""
     #                        #
     #   path optimization:   #
     #                        #
-    t0 = time.time()
-    best_sequence = find_shortest_hamilton_path_XYZ(uncached, table)
-    to_visit = np.array(uncached)[best_sequence]
-    time_while["path"] += time.time() - t0
+    with timing.phase("path"):
+        best_sequence = find_shortest_hamilton_path_XYZ(units, table, time_budget=path_budget)
+    return np.array(units)[best_sequence]
 
-    for unit in population:
-        if unit in cache:
-            unit.fitness = cache[unit]
 
+def needs_full_measurement(unit):
+    """Decides whether a screened unit deserves the full measurement"""
+    if unit.type != "NORMAL":
+        return True
+    rates = neighbourhood_rates(unit)
+    pure = sum(rates[t] for t in ("NORMAL", "RESET", "JUSTRIGHT"))
+    p_changing = (rates["CHANGING"] + 1.0) / (rates["CHANGING"] + pure + 2.0)
+    return p_changing > SCREEN_MAX_CHANGING
 
-    for unit in to_visit:
-        evaluate_unit(vcg, table, unit)
 
-    return [u.fitness for u in population]
+def evaluate_unit(vcg, table, unit, num_measurements=5, adaptive=None, resume=False):
+    """Evaluates a single point, with `num_measurements` measurements"""
+    evaluate_units(vcg, table, [unit], num_measurements, adaptive, resume)
 
 
-def evaluate_unit(vcg, table, unit, num_measurements=5):
-    """Evaluates a single point, with `num_measurements` measurements"""
+def evaluate_units(vcg, table, units, num_measurements=5, adaptive=None, resume=False):
+    """Evaluates points sharing the same position and intensity,
+    with `num_measurements` measurements each.
+
+    The table is moved only once, and the shots are glitched
+    in batches of up to BATCH_PATTERNS patterns (see `glitch_shots`).
+
+    If `adaptive` (by default, if EARLY_STOPPING), a unit stops being
+    measured once `stop_measuring` is confident of its class.
+    If `resume`, the units' earlier measurements count towards the total.
+    """
+    if adaptive is None:
+        adaptive = EARLY_STOPPING
+
+    unit = units[0]
+    assert all(u.x == unit.x and u.y == unit.y and u.intensity == unit.intensity for u in units)
 
     abs_coords = table.gen2coord(unit.x, unit.y)
     table.move_to_position(abs_coords)
 
-    t0 = time.time()
-    table.wait()
-    time_while["moving"] += time.time() - t0
+    with timing.phase("moving", units):
+        table.wait()
 
-    measurements = []
-    responses = []
-
-    i=0
+    if resume:
+        measurements = dict((id(u), list(u.measurements)) for u in units)
+        responses    = dict((id(u), list(u.responses))    for u in units)
+    else:
+        measurements = dict((id(u), []) for u in units)
+        responses    = dict((id(u), []) for u in units)
+    neighbours   = dict((id(u), neighbourhood_rates(u)) for u in units) if adaptive else {}
+
+    def shots_needed(u):
+        taken = measurements[id(u)]
+        if not adaptive:
+            return num_measurements - len(taken)
+        if len(taken) < MIN_MEASUREMENTS:
+            return MIN_MEASUREMENTS - len(taken)
+        if stop_measuring(taken, neighbours[id(u)]):
+            return 0
+        if not all(m == taken[0] for m in taken):
+            return num_measurements - len(taken)        # CHANGING: take them all
+        return min(1, num_measurements - len(taken))
+
+    shots = [u for u in units for _ in range(shots_needed(u))]
+    i = 0
     stuckcounter = 0
-    while i < num_measurements:     # do N measurements (plus any repeated ones)
-        i += 1
+    while i < len(shots):     # do N measurements per unit (plus any repeated ones)
+        batch = shots[i : i+min(BATCH_PATTERNS, vcg.n_patterns)]
+        results = []
         try:
-            t0 = time.time()
-            response = vcg.glitch(intensity=unit.intensity, offset=unit.offset, repeat=unit.repetitions)
-
-            if response == RESPONSE_CORRECT:
-                measurements.append("NORMAL")
-                vcg.reset()
-                time_while["normal"] += time.time() - t0
-            else:
-                measurements.append("JUSTRIGHT")
-                responses.append(response)
-                vcg.reset()
-                time_while["justright"] += time.time() - t0
+            t0 = clock()
+            patterns = [(u.offset, u.repetitions) for u in batch]
+            for response, u in zip(glitch_shots(vcg, unit.intensity, patterns), batch):
+                if response is None:
+                    results.append((u, "RESET", None))
+                elif response == RESPONSE_CORRECT:
+                    results.append((u, "NORMAL", None))
+                else:
+                    results.append((u, "JUSTRIGHT", response))
+                outcome = results[-1][1]
+                after_shot(vcg, outcome)
+                timing.record(outcome.lower(), clock() - t0, [u])
+                t0 = clock()
 
         except VCG_BusyTimeout:
             # if VCG gets stuck in evcg_busy, we
-            # reset the board and repeat the measurement
-            vcg.reset()
-            i -= 1
+            # reset the board and repeat the measurements
+            reset_board(vcg)
+            reset_stats["streak"] = 0
+            reset_stats["previous"] = None
             print("Reset the board")
-            time_while["evcg_busy"] += time.time() - t0
+            timing.record("evcg_busy", clock() - t0, batch)
 
             stuckcounter += 1
             if stuckcounter % 10 == 0:
                 import ipdb; ipdb.set_trace()
+            continue
+
+        for u, measurement, response in results:
+            measurements[id(u)].append(measurement)
+            if response is not None:
+                responses[id(u)].append(response)
+        i += len(batch)
+
+        if i == len(shots) and adaptive:       # decide who needs more
+            shots += [u for u in units for _ in range(shots_needed(u))]
+
+    for u in units:
+        classify_unit(u, measurements[id(u)], responses[id(u)])
+        assert len(u.measurements) <= num_measurements
+        cache[u] = u.fitness
+
+
+def glitch_shots(vcg, intensity, patterns):
+    """Glitches the (offset, repetitions) `patterns`, and yields the board
+    response to each (`None` for a RESET). A single pattern is glitched
+    on its own, with `VCG.glitch`; more go through `VCG.glitch_batch`."""
+    if len(patterns) > 1:
+        for response in vcg.glitch_batch(intensity, patterns, expected=RESPONSE_CORRECT):
+            yield response
+        return
+
+    offset, repeat = patterns[0]
+    try:
+        response = vcg.glitch(intensity, offset, repeat, expected=RESPONSE_CORRECT)
+    except VCG_ReadTimeout:
+        response = None
+    yield response
+
+
+def neighbourhood_rates(unit, radius=CUBE_SIZE):
+    """Counts the classes of the cached units within `radius` of `unit`.
+
+    Returns a dict of {type: count}, plus "agree": for each outcome, how
+    many measurements of the CHANGING neighbours had that outcome, and
+    "total": the number of those measurements.
+    """
+    rates = {"NORMAL": 0, "RESET": 0, "JUSTRIGHT": 0, "CHANGING": 0,
+             "agree": {"NORMAL": 0, "RESET": 0, "JUSTRIGHT": 0}, "total": 0}
+    for u in cache.spatial.within(unit, radius, types=("NORMAL", "RESET", "JUSTRIGHT", "CHANGING")):
+        rates[u.type] += 1
+        if u.type == "CHANGING" and getattr(u, "measurements", None):
+            for m in u.measurements:
+                rates["agree"][m] += 1
+            rates["total"] += len(u.measurements)
+    return rates
+
+
+def stop_measuring(measurements, rates, confidence=None):
+    """Decides whether the measurements so far determine the unit's class.
+
+    Only identical measurements can stop early. The prior probability of
+    a CHANGING unit, and the per-shot probability that a CHANGING unit
+    repeats the observed outcome, come from the neighbourhood `rates`
+    (Laplace-smoothed). We stop once the posterior probability that the
+    unit is CHANGING drops below 1-`confidence`.
+
+    Since an early-stopped unit has identical measurements, its type and
+    fitness are the same as if all the measurements had been taken.
+    """
+    if confidence is None:
+        confidence = EARLY_STOP_CONFIDENCE
+    if not all(m == measurements[0] for m in measurements):
+        return False
+
+    outcome = measurements[0]
+    pure = sum(rates[t] for t in ("NORMAL", "RESET", "JUSTRIGHT"))
+    p_changing = (rates["CHANGING"] + 1.0) / (rates["CHANGING"] + pure + 2.0)
+    q = (rates["agree"][outcome] + 1.0) / (rates["total"] + 2.0)
+
+    # likelihood of the repeats: q^(k-1) if CHANGING, 1 otherwise
+    likelihood = q ** (len(measurements) - 1)
+    posterior = p_changing*likelihood / (p_changing*likelihood + (1-p_changing))
+    return posterior < 1 - confidence
+
+
+def after_shot(vcg, outcome):
+    """Resets the board after a shot with the given outcome,
+    unless conditional resets are on and it's safe to skip it."""
+    if reset_stats["previous"]:
+        reset_stats[reset_stats["previous"]][outcome] += 1
+
+    if CONDITIONAL_RESET and outcome == "NORMAL" and reset_stats["streak"]+1 < RESET_EVERY:
+        reset_stats["streak"]  += 1
+        reset_stats["skipped"] += 1
+        reset_stats["previous"] = "after_normal_skipped"
+    else:
+        with timing.phase("boardreset"):
+            reset_board(vcg)
+        reset_stats["streak"] = 0
+        reset_stats["previous"] = "after_normal_reset" if outcome == "NORMAL" else None
+
 
-        except VCG_ReadTimeout:
-            measurements.append("RESET")
-            vcg.reset()
-            time_while["reset"] += time.time() - t0
+def reset_board(vcg):
+    """Resets the board until it's ready, at most RESET_RETRIES times;
+    returns whether it came up."""
+    for attempt in range(RESET_RETRIES):
+        if vcg.reset():
+            return True
+    print("Board not ready after {} resets".format(RESET_RETRIES))
+    return False
 
-    assert len(measurements) == num_measurements
+
+def classify_unit(unit, measurements, responses):
+    """Sets the unit's measurements, type and fitness
+
+    The fitness is also kept per fidelity level (the number of
+    measurements it's based on) in `unit.fitness_by_fidelity`.
+    """
     unit.measurements = measurements
     unit.responses = responses
 
-
     # classify into classes
     if not all([measurements[0] == m for m in measurements]):
         unit.type = "CHANGING"
@@ -196,4 +527,6 @@ def evaluate_unit(vcg, table, unit, num_measurements=5):
             unit.type = "RESET"
             unit.fitness = 5
 
-    cache[unit] = unit.fitness
+    if not hasattr(unit, "fitness_by_fidelity"):
+        unit.fitness_by_fidelity = {}
+    unit.fitness_by_fidelity[len(measurements)] = unit.fitness
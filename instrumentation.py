@@ -0,0 +1,162 @@
+"""Phase timing for long scans.
+
+`PhaseTimer` keeps the duration of every timed event per phase, so that
+besides the totals we get the distribution (p50/p95/max), both over the
+whole run and over the window since the last snapshot. Snapshots can be
+flushed to a file periodically while the scan runs, to spot drift
+(e.g. resets slowing down) without waiting for the end.
+"""
+from __future__ import print_function, division
+import json
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    clock = time.monotonic
+except AttributeError:     # Python 2
+    clock = time.time
+
+
+class PhaseTimer(object):
+    """Durations (in seconds) of timed events, per phase.
+
+    Usage:
+        timer = PhaseTimer(["moving", "path"], snapshot_file="timing.json")
+        with timer.phase("moving", units):
+            table.wait()
+        timer["moving"]         # total seconds
+        timer.maybe_snapshot()  # writes a snapshot if it's time to
+
+    If the event concerns some units, their share of the duration is also
+    added to each `unit.timings`, a dict of {phase: seconds}.
+
+    Snapshots go to `snapshot_file` every `snapshot_every` seconds: one JSON
+    object per line, or rows of (time, phase, window, stats...) if the
+    filename ends with ".csv".
+    """
+
+    STATS = ["count", "total", "mean", "p50", "p95", "max"]
+
+    def __init__(self, phases=(), snapshot_file=None, snapshot_every=60.0):
+        self.phases = list(phases)
+        self.snapshot_file  = snapshot_file
+        self.snapshot_every = snapshot_every
+        self.lock = threading.Lock()    # the pipeline records from two threads
+        self.reset()
+
+
+    def reset(self):
+        """Forgets all the recorded events."""
+        with self.lock:
+            self.durations = dict((p, array("d")) for p in self.phases)
+            self.totals    = dict((p, 0.0) for p in self.phases)
+            self.window    = dict((p, 0) for p in self.phases)  # index of the first event since the last snapshot
+            self.t0 = self.last_snapshot = clock()
+
+
+    def record(self, phase, seconds, units=()):
+        """Records an event of `phase` that took `seconds`."""
+        with self.lock:
+            if phase not in self.durations:
+                self.phases.append(phase)
+                self.durations[phase] = array("d")
+                self.totals[phase] = 0.0
+                self.window[phase] = 0
+            self.durations[phase].append(seconds)
+            self.totals[phase] += seconds
+
+        for u in units:
+            if getattr(u, "timings", None) is None:
+                u.timings = {}
+            u.timings[phase] = u.timings.get(phase, 0.0) + seconds/len(units)
+
+
+    @contextmanager
+    def phase(self, name, units=()):
+        """Times the body of the `with` block as an event of phase `name`."""
+        t0 = clock()
+        try:
+            yield
+        finally:
+            self.record(name, clock() - t0, units)
+
+
+    def __getitem__(self, phase):
+        return self.totals.get(phase, 0.0)
+
+    def __iter__(self):
+        return iter(self.phases)
+
+    def items(self):
+        return [(p, self[p]) for p in self.phases]
+
+
+    def stats(self, phase, since=0):
+        """Returns a dict of `STATS` over the events of `phase`, from the `since`-th on."""
+        d = np.array(self.durations.get(phase, array("d"))[since:], dtype=float)
+        if not len(d):
+            return dict((s, 0 if s == "count" else 0.0) for s in self.STATS)
+        p50, p95 = np.percentile(d, [50, 95])
+        return {"count": len(d), "total": float(d.sum()), "mean": float(d.mean()),
+                "p50": float(p50), "p95": float(p95), "max": float(d.max())}
+
+
+    def summary(self):
+        """Returns {phase: stats} over the whole run."""
+        with self.lock:
+            return dict((p, self.stats(p)) for p in self.phases)
+
+
+    def snapshot(self):
+        """Returns the stats over the whole run, and over the window since
+        the last snapshot; starts a new window."""
+        with self.lock:
+            now = clock()
+            snap = {
+                "time"    : time.strftime("%Y-%m-%d %H:%M:%S"),
+                "elapsed" : now - self.t0,
+                "window"  : now - self.last_snapshot,
+                "all"     : dict((p, self.stats(p))                 for p in self.phases),
+                "recent"  : dict((p, self.stats(p, self.window[p])) for p in self.phases),
+            }
+            for p in self.phases:
+                self.window[p] = len(self.durations[p])
+            self.last_snapshot = now
+        return snap
+
+
+    def maybe_snapshot(self):
+        """Writes a snapshot if `snapshot_every` seconds have passed since the last one."""
+        if self.snapshot_file and clock() - self.last_snapshot >= self.snapshot_every:
+            self.write_snapshot()
+
+
+    def write_snapshot(self, filename=None):
+        """Appends a snapshot to `filename` (by default, `snapshot_file`)."""
+        filename = filename or self.snapshot_file
+        snap = self.snapshot()
+        with open(filename, "a") as f:
+            if filename.endswith(".csv"):
+                if f.tell() == 0:
+                    print(",".join(["time", "elapsed", "phase", "window"] + self.STATS), file=f)
+                for window in ("all", "recent"):
+                    for p in self.phases:
+                        s = snap[window][p]
+                        print(",".join([snap["time"], "{:.3f}".format(snap["elapsed"]), p, window]
+                                       + ["{!r}".format(s[k]) for k in self.STATS]), file=f)
+            else:
+                print(json.dumps(snap, sort_keys=True), file=f)
+
+
+    def report(self):
+        """Returns the summary as printable lines."""
+        lines = []
+        for p in self.phases:
+            s = self.stats(p)
+            lines.append("Time spent on {:<10s} {:10.3f}s in {:6d} events, "
+                         "p50 {:.4f}s, p95 {:.4f}s, max {:.4f}s".format(
+                         p+":", s["total"], int(s["count"]), s["p50"], s["p95"], s["max"]))
+        return "\n".join(lines)
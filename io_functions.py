@@ -8,6 +8,22 @@ hex_frombytes = lambda b: binascii.hexlify(b).decode("ascii")  # bytes.hex
 bytes_fromhex = lambda b: binascii.unhexlify(b)                # bytes.fromhex
 
 
+def format_cache_line(i, unit):
+    """Formats the `i`-th scanned point as a line of the v2 cache format."""
+    s = "{:d} {:s}".format(i, repr(unit))
+
+    if unit.responses:
+        s += " "
+        s += " ".join(hex_frombytes(resp) for resp in unit.responses)
+
+    if hasattr(unit, "measurements"):
+        measurements = unit.measurements
+        if measurements and not all(measurements[0] == m for m in measurements):
+            s += " $ " + " ".join(measurements)
+
+    return s
+
+
 def write_cache_to_file(filename, cache):
     with open(filename, "w") as f:
 
@@ -16,18 +32,7 @@ def write_cache_to_file(filename, cache):
 
         # numbered scanned points
         for (i, unit) in enumerate(cache):
-            s = "{:d} {:s}".format(i, repr(unit))
-
-            if unit.responses:
-                s += " "
-                s += " ".join(hex_frombytes(resp) for resp in unit.responses)
-
-            if hasattr(unit, "measurements"):
-                measurements = unit.measurements
-                if measurements and not all(measurements[0] == m for m in measurements):
-                    s += " $ " + " ".join(measurements)
-
-            print(s, file=f)
+            print(format_cache_line(i, unit), file=f)
 
 
 def read_cache_from_file(filename):
@@ -55,9 +60,11 @@ def read_cache_from_file(filename):
             cache[unit] = unit.fitness
 
     elif lines[0] == "v2":
-        for line in lines[1:]:
+        # (in a journal, a unit may appear more than once: the last one counts,
+        #  see the check at the end)
+        for i, line in enumerate(lines[1:]):
             splat = line.split()
-            assert len(cache) == int(splat[0])
+            assert i == int(splat[0])
             unit = Unit(splat[1])
 
             if "$" in splat:
@@ -69,6 +76,7 @@ def read_cache_from_file(filename):
 
             unit.responses = [bytes_fromhex(r) for r in Rs]    # responses, if any
             unit.measurement_types = Ms                        # measurement types, if any
+            cache.pop(unit, None)                              # (else the first one's key stays)
             cache[unit] = unit.fitness
 
     else:
@@ -101,3 +109,23 @@ def write_responses_to_file(filename, responses, cropped=False):
         f.write(struct.pack("<I", len(responses)))
         for r in responses:
             f.write(r)
+
+
+
+if __name__ == "__main__":
+    # round trip of a journal that measured the same unit twice
+    import os, tempfile
+    first, again = Unit("(0.5,0.5,0.5,183600,1,NORMAL,2.0)"), Unit("(0.5,0.5,0.5,183600,1,RESET,5.0)")
+    again.responses = first.responses = []
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        with open(filename, "w") as f:
+            print("v2", file=f)
+            print(format_cache_line(0, first), file=f)
+            print(format_cache_line(1, again), file=f)
+        (unit, fitness), = read_cache_from_file(filename).items()
+        assert (unit.type, unit.fitness, fitness) == ("RESET", 5.0, 5.0)
+        print("OK")
+    finally:
+        os.remove(filename)
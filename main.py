@@ -7,18 +7,29 @@ from ga import *
 from gui import GUI
 from io_functions import *
 from unit import *
+from tsp import nearest_neighbour_order
+from motion import MotionModel, MOTIONFILE, calibrate_motion_model
+from pipeline import Pipeline
+from serial_trace import SerialTrace
+from surrogate import Surrogate
+from population import Population
 
 import numpy as np
 import random
 
 
-commands = ["grid", "random", "algo"]
+commands = ["grid", "random", "algo", "steady", "calibrate"]
 
 
 CACHEFILE = "cached.txt"
 POPFILE   = "population.txt"
+JOURNALFILE = "journal.txt"
+TIMINGFILE = "timing.json"  # ".csv" for CSV
+TRACEFILE = None            # e.g. "serial.trace", to log all the serial traffic
 N_ITERS   = 50
 POPSIZE   = 20
+QUEUE_LEN = 3       # steady-state GA: units planned ahead of the hardware
+BREED_POOL = 20     # steady-state GA: children to pick each new unit from
 
 def grid_search(vcg, table,
                 xrange=(0.0, 1.0),
@@ -53,18 +64,21 @@ def grid_search(vcg, table,
         even = not even
         for y in np.linspace(yrange[0], yrange[1], spatial_granul)[::1 if even else -1]:    # go the other way around every other turn
             for intensity in np.linspace(irange[0], irange[1], int_granul):
+                units = []
                 for offset in offset_ms:
                     u = Unit()
                     u.x = x; u.y = y; u.intensity = intensity; u.offset = offset; u.repetitions = repetitions
-                    evaluate_unit(vcg, table, u)
-
-                    counter += 1
-                    if counter%100 == 0 or counter == num_to_visit:
-                        dt = time.time() - t0
-                        done = float(counter)/num_to_visit
-                        left = (dt/done) * (1-done)
-                        print("Evaluated {}/{}, or {:.3f}% ({:.1f}s elapsed, {:.1f} left)".format(
-                            counter, num_to_visit, 100*done, dt, left))
+                    units.append(u)
+                evaluate_units(vcg, table, units)       # all offsets at one position
+                timing.maybe_snapshot()
+
+                counter += len(units)
+                if counter%100 < len(units) or counter == num_to_visit:
+                    dt = time.time() - t0
+                    done = float(counter)/num_to_visit
+                    left = (dt/done) * (1-done)
+                    print("Evaluated {}/{}, or {:.3f}% ({:.1f}s elapsed, {:.1f} left)".format(
+                        counter, num_to_visit, 100*done, dt, left))
     return cache
 
 
@@ -74,33 +88,28 @@ def random_search(vcg, table, N):
     Random parameter search; scans N points.
 
     Uses nearest-neighbor heuristic for finding shortest path.
+    The points are generated up front and ordered lazily,
+    so the first measurement starts right away.
     """
 
-    scanned = []
-    to_scan = [Unit() for _ in range(N)]
-    u = None
+    xy          = np.random.random((N, 2))
+    intensities = np.random.random(N)
+    offsets     = np.random.randint(OFFSET_MIN, OFFSET_MAX+1, size=N)
+    repetitions = np.random.randint(REP_MIN, REP_MAX+1, size=N)
 
-    counter = 0
-    t0 = time.time()
-
-    while to_scan:
-
-        # find next point
-        if u is None:       # initial case
-            u = to_scan[0]
-        else:               # otherwise, nearest neighbor
-            u = min((u.distance_to(x, xy_plane=True), x) for x in to_scan)[1]
-        to_scan.remove(u)
-
-        evaluate_unit(vcg, table, u)
-
-        counter += 1
-        if counter%10 == 0 or counter == N:
-            dt = time.time() - t0
-            done = float(counter)/N
-            left = (dt/done) * (1-done)
-            print("Evaluated {}/{}, or {:.3f}% ({:.1f}s elapsed, {:.1f} left)".format(
-                    counter, N, 100*done, dt, left))
+    # the hardware thread starts measuring while we're still planning
+    pipeline = Pipeline(vcg, table, journal=JOURNALFILE, total=N)
+    pipeline.start()
+    try:
+        for i in nearest_neighbour_order(xy):
+            u = Unit()
+            u.x = float(xy[i, 0]); u.y = float(xy[i, 1]); u.intensity = float(intensities[i])
+            u.offset = int(offsets[i]); u.repetitions = int(repetitions[i])
+            pipeline.submit(u)
+    except:
+        pipeline.stop(drain=False)
+        raise
+    pipeline.stop()
 
 
 
@@ -109,46 +118,138 @@ def algo_search(vcg, table):
 
     population = generate_population(POPSIZE)
     N_scanned = []
+    surrogate = Surrogate(exploration=SURROGATE_EXPLORATION) if SURROGATE else None
 
-    print("Starting GA")
-    t0 = tgen = time.time()
-    for i in range(N_ITERS):
-        print("Iteration {}".format(i+1))
-        fits = evaluate_batch(vcg, table, population)
-        population = selection_roulette(population, elite_size=1)
-        print(fits)
-        print("Mean={}, max={}".format(np.mean(fits), np.max(fits)))
-        print("Iteration took {:.2f}s, total {:.2f}".format(time.time()-tgen, time.time()-t0))
-        tgen = time.time()
-
-    t1 = time.time()
-    N_scanned.append(len(cache))
-
-    print("Time elapsed GA/total: {}/{} s".format(t1-t0, t1-t0))
-    print("Scanned points GA/total: {}/{}".format(N_scanned[0], sum(N_scanned)))
-    print(" speed: {}s per point".format((t1-t0)/N_scanned[-1]))
-    print("Starting searches around JUSTRIGHTs")
-
-    for u in [u for u in cache if u.type=="JUSTRIGHT"]:
-        # local search in SMALL cubes
-        for i in range(10):
-            u = copy.deepcopy(u)
-            mutate_unit(u, p_mut=1.0, Q=CUBE_SIZE_SMALL)
-            evaluate_unit(vcg, table, u)
-
-    t3 = time.time()
+    pipeline = Pipeline(vcg, table, journal=JOURNALFILE, report_every=POPSIZE)
+    pipeline.start()
+
+    try:
+        print("Starting GA")
+        t0 = tgen = time.time()
+        for i in range(N_ITERS):
+            print("Iteration {}".format(i+1))
+            moved, scanned = timing["moving"], len(cache)
+            fits = pipeline.evaluate_batch(population.units())
+            population.fitness[:] = fits
+            if TRAVEL_AWARE:
+                at = pipeline.planned_unit
+                population = selection_travel_aware(population, start=(at.x, at.y) if at else (0.0, 0.0),
+                                                    elite_size=1, surrogate=surrogate)
+            elif surrogate:
+                population = selection_surrogate(population, surrogate, elite_size=1)
+            else:
+                population = selection_roulette(population, elite_size=1)
+            print(fits)
+            print("Mean={}, max={}".format(np.mean(fits), np.max(fits)))
+            print("Moving: {:.3f}s per evaluated unit".format((timing["moving"] - moved) / max(1, len(cache) - scanned)))
+            print("Iteration took {:.2f}s, total {:.2f}".format(time.time()-tgen, time.time()-t0))
+            tgen = time.time()
+
+        t1 = time.time()
+        N_scanned.append(len(cache))
+
+        print("Time elapsed GA/total: {}/{} s".format(t1-t0, t1-t0))
+        print("Scanned points GA/total: {}/{}".format(N_scanned[0], sum(N_scanned)))
+        print(" speed: {}s per point".format((t1-t0)/N_scanned[-1]))
+        print("Starting searches around JUSTRIGHTs")
+
+        for u in cache.spatial.of_type("JUSTRIGHT"):
+            # local search in SMALL cubes
+            for i in range(10):
+                u = copy.deepcopy(u)
+                mutate_unit(u, p_mut=1.0, Q=CUBE_SIZE_SMALL)
+                pipeline.submit(u)
+    except:
+        pipeline.stop(drain=False)
+        raise
+    pipeline.stop()
+
+    t2 = time.time()
     N_scanned.append(len(cache) - N_scanned[-1])
     print("{}s elapsed, {}s in total\n{} scanned points".format(t2-t1, t2-t0, len(cache)))
     print("Time elapsed local/total: {}/{} s".format(t2-t1, t2-t0))
     print("Scanned points local/total: {}/{}".format(N_scanned[1], sum(N_scanned)))
-    print(" speed: {}s per point".format((t2-t1)/N_scanned[-1]))
+    print(" speed: {}s per point".format((t2-t1)/max(1, N_scanned[-1])))
 
     print("Total speed: {}s per point".format((t2-t0)/len(cache)))
 
 
 
+def steady_state_search(vcg, table, N, popsize=POPSIZE, queue_len=QUEUE_LEN, pool=BREED_POOL):
+    """
+    Steady-state GA; scans N points.
+
+    Every result goes into the population as soon as it's measured
+    (see `replace_worst`), and the pipeline is kept `queue_len` units
+    ahead of the hardware. Each new unit is bred from the population as
+    it is then: out of `pool` children, the one nearest to where the
+    table will be (of the best quarter, if there's a surrogate), so
+    breeding, planning and measuring overlap all the time.
+    """
+    assert popsize >= 2
+    if N == 0:
+        return
+    population = Population.from_units([])
+    surrogate = Surrogate(exploration=SURROGATE_EXPLORATION) if SURROGATE else None
+    in_flight = set()           # cache keys of the units submitted but not evaluated yet
+
+    def breed():
+        for attempt in range(10):
+            parents1, parents2 = population.select_roulette(pool)
+            children = population.crossover(parents1, parents2)
+            children.mutate(P_MUT)
+            candidates = [i for i in range(pool)
+                          if cache.key(children.unit(i)) not in cache.index
+                          and cache.key(children.unit(i)) not in in_flight]
+            if candidates:
+                break
+        else:
+            return Unit()           # the population has converged: explore
+        if surrogate:
+            scores = surrogate.score(children[np.array(candidates)])
+            candidates = [candidates[i] for i in np.argsort(-scores, kind="mergesort")[:max(1, len(candidates)//4)]]
+        units = [children.unit(i) for i in candidates]
+        return units[int(np.argmin(pipeline.travel_costs(units)))]
+
+    if surrogate:
+        surrogate.update(cache)         # from now on, the hardware thread fills the cache
+    pipeline = Pipeline(vcg, table, journal=JOURNALFILE, total=N, report_every=popsize, collect=True)
+    pipeline.start()
+    t0 = time.time()
+    try:
+        first = generate_population(min(popsize, N)).units()
+        in_flight.update(cache.key(u) for u in first)
+        pipeline.submit_path(first)
+        submitted = queued = len(first)
+        evaluated = 0
+
+        while evaluated < N:
+            while queued < queue_len and submitted < N and len(population) >= 2:
+                unit = breed()
+                in_flight.add(cache.key(unit))
+                pipeline.submit(unit)
+                submitted += 1
+                queued += 1
+
+            unit = pipeline.next_result()
+            in_flight.discard(cache.key(unit))
+            if surrogate:
+                surrogate.add([unit])
+            queued -= 1
+            evaluated += 1
+            population = replace_worst(population, unit, popsize)
+    except:
+        pipeline.stop(drain=False)
+        raise
+    pipeline.stop()
+
+    print("{:.1f}s elapsed, {} scanned points, best fitness {}".format(
+          time.time() - t0, len(cache), np.max(population.fitness) if len(population) else None))
+
+
+
 def fatal_usage():
-    print("Usage: python {:s} [grid | random N | algo]".format(sys.argv[0]), file=sys.stderr)
+    print("Usage: python {:s} [grid | random N | algo | steady N | calibrate]".format(sys.argv[0]), file=sys.stderr)
     sys.exit(1)
 
 
@@ -162,15 +263,23 @@ if __name__=="__main__":
 
     cmd = sys.argv[1].lower()
 
+    trace = SerialTrace() if TRACEFILE else None
     try:
         try:
             f = open("points.txt")
-            table = XYTable(f)
+            table = XYTable(f, trace=trace)
             f.close()
         except:
-            table = XYTable()
+            table = XYTable(trace=trace)
         table.connect()
 
+        try:
+            with open(MOTIONFILE) as f:
+                table.motion_model = MotionModel()
+                table.motion_model.read_from_file(f)
+        except IOError:
+            pass
+
         # set points if necessary
         if not table.origin:
             interface = GUI(table)
@@ -178,11 +287,26 @@ if __name__=="__main__":
         
         table.move_to_position(table.gen2coord(0,0))
 
-        vcg = VCG()
+        vcg = VCG(trace=trace)
         print("Have VCG")
-
-
-        if cmd == "random":
+        try:
+            with open(RESETFILE) as f:
+                vcg.read_reset_from_file(f)
+        except IOError:
+            pass
+        if cmd != "calibrate":
+            timing.snapshot_file = TIMINGFILE
+
+
+        if cmd == "calibrate":
+            print("Calibrating motion model")
+            table.motion_model = calibrate_motion_model(table)
+            print("Calibrating board reset")
+            vcg.calibrate_reset(RESPONSE_CORRECT)
+            with open(RESETFILE, "w") as f:
+                vcg.write_reset_to_file(f)
+
+        elif cmd == "random":
             try:
                 N = int(sys.argv[2])
                 assert N >= 0
@@ -191,6 +315,15 @@ if __name__=="__main__":
             print("Starting random search")
             random_search(vcg, table, N)
 
+        elif cmd == "steady":
+            try:
+                N = int(sys.argv[2])
+                assert N >= 0
+            except:
+                fatal_usage()
+            print("Starting steady-state GA")
+            steady_state_search(vcg, table, N)
+
         elif cmd == "grid":
             print("Starting grid search")
             cache = grid_search(vcg, table,
@@ -206,20 +339,22 @@ if __name__=="__main__":
 
 
         # Print the timing stats
-        N = lambda name: sum((
-                               sum(m == name.upper() for m in u.measurements)
-                                  if u.measurements
-                                  else 5 * sum(name == u.type)
-                             ) for u in cache)
-        pct = lambda name: time_while[name]/N(name) if N(name) else 0.0
-        tw = time_while
-        print("Time spent moving: {:.3f}s\n".format(tw["moving"])
-             +"Time spent optimizing path: {:.3f}s\n".format(tw["path"])
-             +"Time spent while evcg_busy: {:.3f}s\n".format(tw["evcg_busy"])
-             +"Time spent on RESETs: {:.3f}s ({:.3f}s per measurement)\n".format(tw["reset"], pct("reset"))
-             +"Time spent on NORMALs: {:.3f}s ({:.3f}s per measurement)\n".format(tw["normal"], pct("normal"))
-             +"Time spent on JUSTRIGHTs: {:.3f}s ({:.3f}s per measurement)\n".format(tw["justright"], pct("justright"))
-             )
+        print(timing.report())
+        print("Cache: {} hits, {} misses".format(cache.hits, cache.misses))
+        print("Moving: {:.3f}s per evaluated unit".format(timing["moving"] / max(1, len(cache))))
+        if cmd != "calibrate":
+            for outcome, (count, total, worst) in sorted(vcg.response_latency.items()):
+                if count:
+                    print("Reading {} responses: {:.4f}s on average, {:.4f}s at most".format(outcome, total/count, worst))
+            if vcg.busy_times:
+                print("VCG busy for {:.5f}s (median), first polled after {:.5f}s, declared stuck after {:.4f}s".format(
+                      float(np.median(vcg.busy_times)), vcg.busy_schedule[0], vcg.busy_schedule[2]))
+        if reset_stats["skipped"]:
+            share = lambda d: ", ".join("{} {:.2f}%".format(k, 100.0*v/max(1, sum(d.values()))) for k, v in sorted(d.items()))
+            print("Skipped {} resets\n".format(reset_stats["skipped"])
+                 +"  outcomes after NORMAL, reset:    {}\n".format(share(reset_stats["after_normal_reset"]))
+                 +"  outcomes after NORMAL, skipped:  {}\n".format(share(reset_stats["after_normal_skipped"]))
+                 )
         
     except KeyboardInterrupt:
         print("Killed by KeyboardInterrupt")
@@ -237,6 +372,15 @@ if __name__=="__main__":
         # 1. save the corner points
         with open("points.txt","w") as f:
             table.write_to_file(f)
+        if table.motion_model:
+            with open(MOTIONFILE, "w") as f:
+                table.motion_model.write_to_file(f)
+
+        if timing.snapshot_file:
+            timing.write_snapshot()
+        if trace:
+            print(trace.report())
+            trace.save(TRACEFILE)
 
         # 2. write out (numbered) scan results
         print("Writing out scan results")
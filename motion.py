@@ -0,0 +1,160 @@
+from __future__ import print_function, division
+import time
+import numpy as np
+
+from xyz_table import Axis, Point
+
+MOTIONFILE = "motion.txt"
+
+
+class AxisProfile(object):
+    """Trapezoidal velocity profile of a single axis.
+
+    A move of `d` microsteps accelerates at `accel` up to `vmax`, cruises,
+    and decelerates again; if `d` is too short to reach `vmax`, the
+    profile is triangular. `settle` is the constant overhead per move
+    (serial commands, settling, and noticing the arrival).
+    """
+    def __init__(self, vmax, accel, settle):
+        self.vmax   = float(vmax)      # microsteps/s
+        self.accel  = float(accel)     # microsteps/s^2
+        self.settle = float(settle)    # s
+
+    def move_time(self, distance):
+        """Time (in seconds) to move `distance` microsteps; works on arrays."""
+        d = np.abs(np.asarray(distance, dtype=float))
+        v, a = self.vmax, self.accel
+        t = np.where(d < v*v/a,
+                     2*np.sqrt(d/a),        # triangular: never reaches vmax
+                     d/v + v/a)             # trapezoidal
+        return np.where(d > 0, t + self.settle, 0.0)
+
+    def __str__(self):
+        return "(vmax={:.1f}, accel={:.1f}, settle={:.4f})".format(self.vmax, self.accel, self.settle)
+
+
+class MotionModel(object):
+    """Predicts the time the table takes to move between two points.
+
+    All axes are moved at once, so a move takes as long as its slowest axis.
+    Axes without a profile of their own use the slowest profile we have.
+    """
+    def __init__(self, profiles=None):
+        self.profiles = dict(profiles) if profiles else {}
+
+    def profile(self, axis):
+        if axis in self.profiles:
+            return self.profiles[axis]
+        return max(self.profiles.values(), key=lambda p: p.move_time(1000.0))
+
+    def travel_time(self, p1, p2):
+        """Predicted time (in seconds) to move from Point `p1` to Point `p2`."""
+        return max(float(self.profile(axis).move_time(getattr(p2, axis.name) - getattr(p1, axis.name)))
+                   for axis in Axis)
+
+    def time_matrix(self, cities):
+        """Matrix of predicted travel times between the cities,
+        given as an (N, 3) array of (x, y, z) coordinates.
+        """
+        cities = np.asarray(cities, dtype=float)
+        assert len(cities.shape)==2 and cities.shape[1]==3
+
+        columns = {Axis.x: 0, Axis.y: 1, Axis.z: 2}
+        times = np.zeros((len(cities), len(cities)))
+        for axis, col in columns.items():
+            diff = cities[:, None, col] - cities[None, :, col]
+            times = np.maximum(times, self.profile(axis).move_time(diff))
+        return times
+
+    def read_from_file(self, motion_file):
+        for line in motion_file:
+            line = line.strip()
+            if not line:
+                continue
+            name, vmax, accel, settle = line.split(",")
+            self.profiles[Axis[name]] = AxisProfile(vmax, accel, settle)
+
+    def write_to_file(self, motion_file):
+        for axis, p in sorted(self.profiles.items(), key=lambda item: item[0].value):
+            print("{},{!r},{!r},{!r}".format(axis.name, p.vmax, p.accel, p.settle), file=motion_file)
+
+
+
+def fit_axis_profile(distances, times):
+    """Least-squares fit of a trapezoidal `AxisProfile` to measured move times.
+
+    For a given (vmax, accel), the best settle time has a closed form
+    (the mean residual), so we only search over (vmax, accel),
+    on a log-spaced grid that's refined around the best point.
+    """
+    d = np.abs(np.asarray(distances, dtype=float))
+    t = np.asarray(times, dtype=float)
+    assert len(d) == len(t) and len(d) >= 3
+
+    lo_v, hi_v = np.log10(d.max()/100), np.log10(d.max()*100)
+    lo_a, hi_a = lo_v - 2, hi_v + 2
+
+    best = None
+    for _ in range(4):
+        for v in np.logspace(lo_v, hi_v, 40):
+            for a in np.logspace(lo_a, hi_a, 40):
+                pred = AxisProfile(v, a, 0.0).move_time(d)
+                settle = max(0.0, np.mean(t - pred))
+                err = np.sum((pred + settle - t)**2)
+                if best is None or err < best[0]:
+                    best = (err, v, a, settle)
+        # zoom in around the best point
+        step_v = (hi_v - lo_v) / 10
+        step_a = (hi_a - lo_a) / 10
+        lo_v, hi_v = np.log10(best[1]) - step_v, np.log10(best[1]) + step_v
+        lo_a, hi_a = np.log10(best[2]) - step_a, np.log10(best[2]) + step_a
+
+    _, v, a, settle = best
+    return AxisProfile(v, a, settle)
+
+
+
+def time_move(table, position):
+    """Moves the table to `position`, returns the time taken (in seconds).
+    The table is polled, so that its current motion model doesn't matter."""
+    t0 = time.time()
+    table.move_to_position(position)
+    table.wait(predictive=False)
+    return time.time() - t0
+
+
+
+def calibrate_motion_model(table, axes=(Axis.x, Axis.y), distances=None, repeats=2):
+    """Measures moves of the table along each of `axes` and fits a `MotionModel`.
+
+    Every distance (in microsteps) is travelled forth and back `repeats`
+    times, starting from the current position. If no distances are given,
+    we use fractions of the chip's extent along the axis.
+
+    The z axis isn't calibrated by default, since moving it far could
+    crash the probe into the chip; it uses the slowest calibrated profile.
+    """
+    start = table.get_position()
+    model = MotionModel()
+
+    for axis in axes:
+        if distances is None:
+            corners = [table.origin, table.xpoint, table.ypoint]
+            coords = [getattr(p, axis.name) for p in corners]
+            span = max(max(coords) - min(coords), 1)
+            dists = [max(1, int(span*f)) for f in (0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)]
+        else:
+            dists = distances
+
+        measured_d = []
+        measured_t = []
+        for d in dists:
+            step = Point(*[d if a == axis else 0 for a in (Axis.x, Axis.y, Axis.z)])
+            for _ in range(repeats):
+                measured_t.append(time_move(table, start + step)); measured_d.append(d)
+                measured_t.append(time_move(table, start));        measured_d.append(d)
+
+        model.profiles[axis] = fit_axis_profile(measured_d, measured_t)
+        print("Axis {}: {}".format(axis.name, model.profiles[axis]))
+
+    return model
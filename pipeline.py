@@ -0,0 +1,211 @@
+from __future__ import print_function, division
+import threading
+import time
+import numpy as np
+
+try:     # Python 2
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+import ga
+from ga import cache, evaluate_unit, needs_full_measurement, PATH_TIME_BUDGET
+from tsp import find_shortest_hamilton_path_XYZ
+from io_functions import format_cache_line
+
+
+class Pipeline(object):
+    """Evaluation pipeline that keeps the rig busy.
+
+    A hardware thread is the only one that talks to the `XYTable` and
+    the `VCG`: it evaluates submitted units in order. A bookkeeping thread
+    journals every result, reports progress and writes the timing snapshots. The caller only plans
+    and submits units, so planning overlaps with the table moving.
+
+    Usage:
+        pipeline = Pipeline(vcg, table, journal="journal.txt")
+        pipeline.start()
+        ... pipeline.submit(unit) / pipeline.evaluate_batch(population) ...
+        pipeline.stop()
+    """
+
+    def __init__(self, vcg, table, journal=None, total=None, report_every=10, collect=False):
+        self.vcg   = vcg
+        self.table = table
+
+        self.journal      = journal         # filename for the results, as they come in
+        self.total        = total           # number of units we expect, for progress reports
+        self.report_every = report_every
+
+        self.todo = Queue()                 # units for the hardware thread
+        self.done = Queue()                 # evaluated units for the bookkeeping thread
+        self.results = Queue() if collect else None     # journaled units, for `next_result`
+        self.error = None
+        self.cancelled = False
+
+        self.submitted = 0
+        self.finished  = 0
+
+        # where the table will be once everything submitted is evaluated,
+        #  and the unit it'll be at (if any)
+        self.planned_position = table.last_target or table.get_position()
+        self.planned_unit = None
+
+        self.hardware   = threading.Thread(target=self._hardware_loop)
+        self.bookkeeper = threading.Thread(target=self._bookkeeping_loop)
+        self.hardware.daemon = self.bookkeeper.daemon = True
+
+
+    def start(self):
+        self.t0 = time.time()
+        self.hardware.start()
+        self.bookkeeper.start()
+
+
+    def stop(self, drain=True):
+        """Waits for the submitted units to be evaluated and journaled, then stops the threads.
+        If not `drain`, the units that haven't been started yet are dropped.
+        """
+        if not drain:
+            self.cancelled = True
+        self.todo.put(None)
+        self.hardware.join()
+        self.done.put(None)
+        self.bookkeeper.join()
+        self._check_error()
+
+
+    def submit(self, unit, **kwargs):
+        """Queues `unit` for evaluation; returns immediately.
+        `kwargs` are passed on to `ga.evaluate_unit`.
+        """
+        self._check_error()
+        self.submitted += 1
+        self.planned_position = self.table.gen2coord(unit.x, unit.y)
+        self.planned_unit = unit
+        self.todo.put((unit, kwargs))
+
+
+    def wait(self):
+        """Returns when all the submitted units have been evaluated."""
+        self.todo.join()
+        self._check_error()
+
+
+    def next_result(self, timeout=None):
+        """Returns the next evaluated unit, in the order they were evaluated
+        (only if `collect`); `None` if there's none within `timeout` seconds."""
+        t0 = time.time()
+        while timeout is None or time.time() - t0 < timeout:
+            try:
+                return self.results.get(timeout=0.1)
+            except Empty:
+                self._check_error()
+        return None
+
+
+    def travel_costs(self, units):
+        """Predicted cost of moving to each of the units from where the table
+        will be once everything submitted is evaluated (in seconds, if the
+        table has a motion model, else in microsteps along the longest axis)."""
+        start = self.planned_position
+        coords = [self.table.gen2coord(u.x, u.y) for u in units]
+        if self.table.motion_model:
+            return [self.table.motion_model.travel_time(start, c) for c in coords]
+        return [np.abs((c - start).as_array()).max() for c in coords]
+
+
+    def evaluate_batch(self, population, path_budget=PATH_TIME_BUDGET, screening=None):
+        """Like `ga.evaluate_batch`, but the table starts moving towards the
+        nearest unit while the rest of the path is being optimized.
+        """
+        if screening is None:
+            screening = ga.SCREENING
+
+        uncached = ga.uncached_units(population)
+
+        if uncached and not screening:
+            self.submit_path(uncached, path_budget)
+            self.wait()
+        elif uncached:
+            self.submit_path(uncached, path_budget, num_measurements=1, adaptive=False)
+            self.wait()
+            promising = [u for u in uncached if needs_full_measurement(u)]
+            if promising:
+                self.submit_path(promising, path_budget, resume=True)
+                self.wait()
+
+        for unit in population:
+            unit.fitness = cache[unit]
+
+        return [u.fitness for u in population]
+
+
+    def submit_path(self, units, path_budget=PATH_TIME_BUDGET, **kwargs):
+        """Submits the units along a planned path. The nearest one is
+        submitted first, so the table starts moving while we plan the rest.
+        """
+        units = list(units)
+        first = units.pop(int(np.argmin(self.travel_costs(units))))
+        self.submit(first, **kwargs)
+
+        if units:
+            with ga.timing.phase("path"):
+                sequence = find_shortest_hamilton_path_XYZ(units, self.table,
+                                                           time_budget=path_budget,
+                                                           start=self.planned_position)
+            for i in sequence:
+                self.submit(units[i], **kwargs)
+
+
+    def _check_error(self):
+        if self.error is not None:
+            raise self.error
+
+
+    def _hardware_loop(self):
+        while True:
+            job = self.todo.get()
+            try:
+                if job is None:
+                    return
+                if self.error is None and not self.cancelled:     # else just drain the queue
+                    unit, kwargs = job
+                    evaluate_unit(self.vcg, self.table, unit, **kwargs)
+                    self.done.put(unit)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.todo.task_done()
+
+
+    def _bookkeeping_loop(self):
+        journal = None
+        if self.journal:
+            journal = open(self.journal, "w")
+            print("v2", file=journal)
+
+        try:
+            while True:
+                unit = self.done.get()
+                if unit is None:
+                    return
+
+                if journal:
+                    print(format_cache_line(self.finished, unit), file=journal)
+                    journal.flush()
+                if self.results is not None:
+                    self.results.put(unit)
+                ga.timing.maybe_snapshot()
+
+                self.finished += 1
+                total = self.total or self.submitted
+                if self.finished % self.report_every == 0 or self.finished == self.total:
+                    dt = time.time() - self.t0
+                    done = float(self.finished)/total
+                    left = (dt/done) * (1-done)
+                    print("Evaluated {}/{}, or {:.3f}% ({:.1f}s elapsed, {:.1f} left)".format(
+                            self.finished, total, 100*done, dt, left))
+        finally:
+            if journal:
+                journal.close()
@@ -0,0 +1,112 @@
+from __future__ import print_function, division
+import numpy as np
+
+from unit import Unit, OFFSET_MIN, OFFSET_MAX, OFFSET_RANGE, REP_MIN, REP_MAX
+
+
+class Population(object):
+    """A population of solutions, as one array per parameter.
+
+    The GA operators work on whole arrays at once; `Unit`s are only
+    made (with `units`) when the population is to be evaluated.
+    Unevaluated solutions have a fitness of NaN.
+    """
+    FIELDS = ["x", "y", "intensity", "offset", "repetitions", "fitness"]
+
+    def __init__(self, x, y, intensity, offset, repetitions, fitness=None):
+        self.x           = np.asarray(x, dtype=float)
+        self.y           = np.asarray(y, dtype=float)
+        self.intensity   = np.asarray(intensity, dtype=float)
+        self.offset      = np.asarray(offset, dtype=int)
+        self.repetitions = np.asarray(repetitions, dtype=int)
+        if fitness is None:
+            fitness = np.full(len(self.x), np.nan)
+        self.fitness     = np.asarray(fitness, dtype=float)
+
+    @classmethod
+    def random(cls, N):
+        """N random solutions, distributed like `Unit()`s"""
+        return cls(np.random.random(N), np.random.random(N), np.random.random(N),
+                   np.random.randint(OFFSET_MIN, OFFSET_MAX+1, size=N),
+                   np.random.randint(REP_MIN, REP_MAX+1, size=N))
+
+    @classmethod
+    def from_units(cls, units):
+        fitness = [np.nan if u.fitness is None else u.fitness for u in units]
+        return cls(*([[getattr(u, f) for u in units] for f in cls.FIELDS[:-1]] + [fitness]))
+
+    @classmethod
+    def concatenate(cls, populations):
+        return cls(*[np.concatenate([getattr(p, f) for p in populations]) for f in cls.FIELDS])
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, index):
+        """The solutions at `index` (an array of indices or a mask), as a new Population"""
+        return Population(*[getattr(self, f)[index] for f in self.FIELDS])
+
+    def unit(self, i):
+        u = Unit()
+        u.x, u.y, u.intensity = float(self.x[i]), float(self.y[i]), float(self.intensity[i])
+        u.offset, u.repetitions = int(self.offset[i]), int(self.repetitions[i])
+        u.fitness = None if np.isnan(self.fitness[i]) else float(self.fitness[i])
+        return u
+
+    def units(self):
+        """The solutions as a list of new `Unit`s"""
+        return [self.unit(i) for i in range(len(self))]
+
+    def set_unit(self, i, unit):
+        """Overwrites the i-th solution with `unit`"""
+        for f in self.FIELDS[:-1]:
+            getattr(self, f)[i] = getattr(unit, f)
+        self.fitness[i] = np.nan if unit.fitness is None else unit.fitness
+
+
+    def crossover(self, parents1, parents2):
+        """Children of the pairs of parents (given as index arrays).
+
+        Every parameter of a child is drawn uniformly between those of
+        its parents (both included, for the integer ones).
+        """
+        N = len(parents1)
+        p1, p2 = self[parents1], self[parents2]
+        blend = lambda a, b: np.random.random(N)*(a - b) + b
+        between = lambda a, b: np.minimum(a, b) + (np.random.random(N)*(np.abs(a - b) + 1)).astype(int)
+        return Population(blend(p1.x, p2.x), blend(p1.y, p2.y), blend(p1.intensity, p2.intensity),
+                          between(p1.offset, p2.offset), between(p1.repetitions, p2.repetitions))
+
+
+    def mutate(self, p_mut, Q=0.50):
+        """Mutates every parameter with probability `p_mut`, in place.
+
+        x, y and intensity move by up to Q/2 either way, the offset by up to
+        half its range (clipped to their ranges); repetitions are redrawn.
+        """
+        N = len(self)
+        rand = np.random.random
+        step = lambda a: np.clip(a + rand(N)*Q - Q/2, 0.0, 1.0)
+        for f in ("x", "y", "intensity"):
+            setattr(self, f, np.where(rand(N) < p_mut, step(getattr(self, f)), getattr(self, f)))
+        self.repetitions = np.where(rand(N) < p_mut, np.random.randint(1, 11, size=N), self.repetitions)
+        new_offs = np.round(np.clip(self.offset + rand(N)*OFFSET_RANGE - OFFSET_RANGE/2, OFFSET_MIN, OFFSET_MAX))
+        self.offset = np.where(rand(N) < p_mut, new_offs.astype(int), self.offset)
+        self.fitness = np.full(N, np.nan)      # no longer evaluated
+
+
+    def select_roulette(self, N):
+        """Draws N pairs of parents, with probabilities proportional to their
+        fitness (shifted to be non-negative); returns two index arrays.
+        """
+        fits = np.array(self.fitness, dtype=float)
+        if fits.min() < 0:
+            fits -= fits.min()
+        p = fits/fits.sum() if fits.sum() > 0 else None
+        parents = np.random.choice(len(self), size=(2, N), p=p)
+        return parents[0], parents[1]
+
+
+    def elite(self, n):
+        """Indices of the `n` fittest solutions, best first"""
+        return np.argsort(-self.fitness, kind="mergesort")[:n]
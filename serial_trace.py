@@ -0,0 +1,314 @@
+"""Tracing of the serial traffic to the table and the target board.
+
+A `TracedSerial` wraps a serial port and logs every write, read and
+input flush, with timestamps, into a `SerialTrace`: a binary ring
+buffer of fixed-size records, so that tracing a long scan takes bounded
+memory. The trace is split into transactions (a write and the reads
+that follow it), labelled by command (`MVP`, `GAP`, `MST`, ... on the
+table, "read" on the target), for latency histograms:
+
+    trace = SerialTrace()
+    table = XYTable(trace=trace)
+    vcg   = VCG(trace=trace)
+    ...
+    print(trace.report())
+    trace.save("serial.trace")
+
+A `ReplayPort` plays a recorded port back: every write releases the
+bytes that were read after the corresponding recorded write, with the
+recorded latencies, so the serial layer can be timed without hardware:
+
+    table = XYTable(ser=ReplayPort(SerialTrace.load("serial.trace"), "table"))
+"""
+from __future__ import print_function, division
+import struct
+import threading
+import time
+import numpy as np
+
+from instrumentation import clock
+from simulator import _SimPort
+
+# Record: start time, duration (both in seconds since the trace started),
+#  port, operation, data length, and the first DATA_LEN bytes of data;
+#  longer data continues in the next records (with CONTINUED set).
+RECORD   = struct.Struct("<ddBBH")
+DATA_LEN = 32
+RECORD_SIZE = RECORD.size + DATA_LEN
+
+WRITE, READ, FLUSH = 1, 2, 3
+CONTINUED = 0x80
+
+MAGIC = b"SERTRACE1\n"
+
+LATENCY_BINS = np.logspace(-4, 0, 21)   # 100us .. 1s
+
+
+def tmcl_label(data):
+    """Names a batch of TMCL requests by their command, e.g. "GAP" or "MVP+MST"."""
+    from xyz_table import Command
+    names = []
+    for i in range(0, len(data) - len(data) % 9, 9):
+        try:
+            name = Command(bytearray(data)[i+1]).name
+        except ValueError:
+            name = "?"
+        if name not in names:
+            names.append(name)
+    return "+".join(names) or "?"
+
+
+def target_label(data):
+    return "read"
+
+# labels of the transactions, by port name; unknown ports use "write"
+LABELS = {"table": tmcl_label, "target": target_label}
+
+
+class SerialTrace(object):
+    """Ring buffer of the last `capacity` serial operations, on any number of ports."""
+
+    def __init__(self, capacity=1 << 18):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * RECORD_SIZE)
+        self.count = 0              # records written so far (including overwritten ones)
+        self.ports = []             # port names, by port number
+        self.lock = threading.Lock()
+        self.t0 = clock()
+
+
+    def port(self, name):
+        """Returns the number of the port called `name`, adding it if needed."""
+        if name not in self.ports:
+            self.ports.append(name)
+        return self.ports.index(name)
+
+
+    def record(self, port, op, t, duration, data=b""):
+        """Logs an operation that started at clock() `t` and took `duration` seconds."""
+        data = bytes(data)
+        with self.lock:
+            first = True
+            while first or data:
+                chunk, data = data[:DATA_LEN], data[DATA_LEN:]
+                offset = (self.count % self.capacity) * RECORD_SIZE
+                RECORD.pack_into(self.buffer, offset, t - self.t0, duration, port,
+                                 op if first else op | CONTINUED, len(chunk))
+                self.buffer[offset+RECORD.size : offset+RECORD.size+len(chunk)] = chunk
+                self.count += 1
+                first = False
+
+
+    def records(self):
+        """Returns the buffered operations, oldest first, as (t, duration, port, op, data) tuples
+        (with the continued records joined)."""
+        with self.lock:
+            n = min(self.count, self.capacity)
+            start = self.count - n
+            raw = [self._unpack(i % self.capacity) for i in range(start, self.count)]
+
+        out = []
+        for t, duration, port, op, data in raw:
+            if op & CONTINUED:
+                if out:             # else its beginning was overwritten
+                    out[-1] = out[-1][:4] + (out[-1][4] + data,)
+                continue
+            out.append((t, duration, port, op, data))
+        return out
+
+    def _unpack(self, i):
+        offset = i * RECORD_SIZE
+        t, duration, port, op, length = RECORD.unpack_from(self.buffer, offset)
+        data = bytes(self.buffer[offset+RECORD.size : offset+RECORD.size+length])
+        return t, duration, port, op, data
+
+
+    def transactions(self, name):
+        """Splits the operations on port `name` into transactions.
+
+        A transaction starts with a write (or an input flush) and includes
+        the reads up to the next one. Returns a list of (label, start,
+        latency, written data, [(end of read, data read)]), with times in
+        seconds since the trace started; the latency runs from the start of
+        the write to the end of the last read.
+        """
+        if name not in self.ports:
+            return []
+        port = self.ports.index(name)
+        label = LABELS.get(name, lambda data: "write")
+
+        out = []
+        for t, duration, p, op, data in self.records():
+            if p != port:
+                continue
+            if op == WRITE:
+                out.append([label(data), t, duration, data, []])
+            elif op == FLUSH:
+                out.append(["flush", t, duration, b"", []])
+            elif out:                   # reads before the first write are dropped
+                out[-1][2] = t + duration - out[-1][1]
+                out[-1][4].append((t + duration, data))
+        return [tuple(tr) for tr in out]
+
+
+    def latencies(self, name):
+        """Returns {label: array of latencies} of the transactions on port `name`."""
+        out = {}
+        for label, _, latency, _, _ in self.transactions(name):
+            out.setdefault(label, []).append(latency)
+        return dict((label, np.array(l)) for label, l in out.items())
+
+
+    def histograms(self, name, bins=LATENCY_BINS):
+        """Returns {label: counts} of the latencies on port `name`; the counts
+        are for below bins[0], between the bins, and above bins[-1]."""
+        return dict((label, np.bincount(np.searchsorted(bins, l), minlength=len(bins)+1))
+                    for label, l in self.latencies(name).items())
+
+
+    def polls_per_wait(self):
+        """Number of GAP batches between two moves of the table, i.e. how often `wait` loops."""
+        polls = []
+        for label, _, _, _, _ in self.transactions("table"):
+            if "MVP" in label:
+                polls.append(0)
+            elif label == "GAP" and polls:
+                polls[-1] += 1
+        return polls
+
+
+    def report(self):
+        """Returns the latency statistics per port and label, as printable lines."""
+        lines = []
+        for name in self.ports:
+            for label, l in sorted(self.latencies(name).items()):
+                lines.append("{:>6s} {:<8s} {:7d} transactions, p50 {:.5f}s, p95 {:.5f}s, max {:.5f}s".format(
+                             name, label, len(l), np.percentile(l, 50), np.percentile(l, 95), l.max()))
+        polls = self.polls_per_wait()
+        if polls:
+            lines.append("Polled {:.2f} times per move on average, at most {}".format(np.mean(polls), max(polls)))
+        if self.count > self.capacity:
+            lines.append("(only the last {} of {} operations were kept)".format(self.capacity, self.count))
+        return "\n".join(lines)
+
+
+    def save(self, filename):
+        """Writes the buffered operations to `filename`, oldest first."""
+        records = self.records()
+        with open(filename, "wb") as f:
+            f.write(MAGIC)
+            f.write(("\n".join(self.ports) + "\n\n").encode())
+            for t, duration, port, op, data in records:
+                f.write(RECORD.pack(t, duration, port, op, 0))
+                f.write(struct.pack("<I", len(data)))
+                f.write(data)
+
+
+    @classmethod
+    def load(cls, filename):
+        """Reads a trace written by `save`."""
+        with open(filename, "rb") as f:
+            raw = f.read()
+        assert raw.startswith(MAGIC), "Not a serial trace"
+        header_end = raw.index(b"\n\n", len(MAGIC))
+        names = raw[len(MAGIC):header_end].decode().split("\n")
+        pos = header_end + 2
+
+        entries = []
+        while pos < len(raw):
+            t, duration, port, op, _ = RECORD.unpack_from(raw, pos)
+            length, = struct.unpack_from("<I", raw, pos + RECORD.size)
+            pos += RECORD.size + 4
+            entries.append((t, duration, port, op, raw[pos:pos+length]))
+            pos += length
+
+        trace = cls(capacity=max(1, sum(1 + len(e[4]) // DATA_LEN for e in entries)))
+        trace.ports = [n for n in names if n]
+        for t, duration, port, op, data in entries:
+            trace.record(port, op, trace.t0 + t, duration, data)
+        return trace
+
+
+
+class TracedSerial(object):
+    """Serial port wrapper that logs its traffic into a `SerialTrace`.
+
+    Everything but `write`, `read`, `read_until` and `reset_input_buffer`
+    (including setting attributes, e.g. `timeout`) goes to the wrapped port.
+    """
+    def __init__(self, ser, trace, name):
+        self.__dict__["ser"]   = ser
+        self.__dict__["trace"] = trace
+        self.__dict__["port"]  = trace.port(name)
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.ser, name, value)
+
+    def write(self, data):
+        t0 = clock()
+        n = self.ser.write(data)
+        self.trace.record(self.port, WRITE, t0, clock() - t0, data)
+        return n
+
+    def read(self, size=1):
+        t0 = clock()
+        data = self.ser.read(size)
+        self.trace.record(self.port, READ, t0, clock() - t0, data)
+        return data
+
+    def read_until(self, *args, **kwargs):
+        t0 = clock()
+        data = self.ser.read_until(*args, **kwargs)
+        self.trace.record(self.port, READ, t0, clock() - t0, data)
+        return data
+
+    def reset_input_buffer(self):
+        t0 = clock()
+        self.ser.reset_input_buffer()
+        self.trace.record(self.port, FLUSH, t0, clock() - t0)
+
+
+
+class ReplayPort(_SimPort):
+    """Fake serial port playing back the port `name` of a `SerialTrace`.
+
+    Each write (or input flush) is matched to the next recorded transaction,
+    whose reads are scheduled to arrive with the recorded delays (times
+    `time_scale`). What's written isn't checked against the recording,
+    but the writes that differ are counted in `mismatches`.
+    """
+    def __init__(self, trace, name, baudrate=115200, time_scale=1.0):
+        _SimPort.__init__(self, None, baudrate)
+        self.time_scale = time_scale
+        self.recorded = list(trace.transactions(name))
+        self.recorded.reverse()         # we pop from the end
+        self.mismatches = 0
+
+    def byte_time(self):
+        return 10.0 / self.baudrate * self.time_scale
+
+    def replay(self, now, kind):
+        """Schedules the reads of the next recorded transaction of `kind` ("write" or "flush")."""
+        while self.recorded and (self.recorded[-1][0] == "flush") != (kind == "flush"):
+            self.recorded.pop()         # the code being replayed skipped it
+            self.mismatches += 1
+        if not self.recorded:
+            return None
+        label, start, latency, written, reads = self.recorded.pop()
+        for end, data in reads:
+            if data:
+                last = now + (end - start) * self.time_scale
+                self.schedule(data, last - (len(data)-1)*self.byte_time())
+        return written
+
+    def write(self, data):
+        if self.replay(time.time(), "write") != bytes(data):
+            self.mismatches += 1
+        return len(data)
+
+    def reset_input_buffer(self):
+        _SimPort.reset_input_buffer(self)
+        self.replay(time.time(), "flush")
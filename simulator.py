@@ -0,0 +1,448 @@
+"""Simulated rig: the VCGlitcher, the TMCL XYZ-table and the target board.
+
+Everything runs in real time (optionally sped up with `time_scale`),
+with configurable baud rates, motor speeds, busy times and reset
+latencies, so that the code in `ga`, `tsp`, `xyz_table` and `vcg`
+can be run and timed without the hardware:
+
+    rig   = SimRig(seed=0)
+    table = rig.make_table()
+    vcg   = rig.make_vcg()
+    evaluate_unit(vcg, table, Unit())
+
+Whether a shot glitches the board is decided by a synthetic `FaultMap`
+over (x, y, intensity, offset).
+"""
+from __future__ import print_function, division
+import math
+import struct
+import time
+from collections import deque
+import numpy as np
+
+from xyz_table import XYTable, Point, Axis, Command, AxisParameter
+from vcg import AMPLITUDE_LO, AMPLITUDE_HI, STARTBYTE, RESPLEN, TIMEOUT
+from ga import RESPONSE_CORRECT
+from unit import OFFSET_MIN, OFFSET_RANGE
+
+
+class FaultMap(object):
+    """Synthetic map of the chip's sensitivity.
+
+    There are `n_spots` sensitive spots, each with a radius, an offset
+    window and an intensity threshold. Past the threshold the board starts
+    to fail: just past it, with a faulty response (JUSTRIGHT), further
+    past it, by going silent (RESET).
+    """
+    def __init__(self, seed=0, n_spots=4, radius=0.05, offset_width=0.15, steepness=0.03, justright_band=0.08):
+        rng = np.random.RandomState(seed)
+        self.centers    = rng.uniform(0.1, 0.9, size=(n_spots, 2))
+        self.offsets    = rng.uniform(0.2, 0.8, size=n_spots)      # as fractions of the offset range
+        self.thresholds = rng.uniform(0.4, 0.8, size=n_spots)
+        self.radius         = radius
+        self.offset_width   = offset_width
+        self.steepness      = steepness
+        self.justright_band = justright_band
+
+    def probabilities(self, x, y, intensity, offset, repetitions=1):
+        """Returns the probabilities of (NORMAL, JUSTRIGHT, RESET)."""
+        o = (offset - OFFSET_MIN) / float(OFFSET_RANGE)
+        d2 = ((self.centers - (x, y))**2).sum(axis=1)
+        sensitivity = (np.exp(-d2 / (2*self.radius**2))
+                     * np.exp(-(o - self.offsets)**2 / (2*self.offset_width**2)))
+        k = int(np.argmax(sensitivity))
+
+        effective = intensity * sensitivity[k] * (1 + 0.1*(repetitions-1))
+        excess = effective - self.thresholds[k]
+
+        p_effect = 1.0 / (1.0 + math.exp(-excess/self.steepness))
+        p_justright = p_effect * math.exp(-(excess/self.justright_band)**2)
+        p_reset = p_effect - p_justright
+        return (1.0 - p_effect, p_justright, p_reset)
+
+
+POLL_INTERVAL = 0.001      # how often a blocking read checks for new data, in seconds
+
+
+class _SimPort(object):
+    """Serial port whose incoming bytes arrive at scheduled times.
+
+    Follows pyserial's semantics for `timeout` (for the whole read)
+    and `inter_byte_timeout` (between two bytes); without a timeout,
+    a read blocks until the data arrives (scheduled by another thread,
+    if nothing is scheduled yet), checking every POLL_INTERVAL.
+    """
+    def __init__(self, rig, baudrate):
+        self.rig = rig
+        self.baudrate = baudrate
+        self.port = None
+        self.timeout = None
+        self.inter_byte_timeout = None
+        self.is_open = True
+        self.incoming = deque()     # (arrival time, byte)
+
+    def byte_time(self):
+        return 10.0 / self.baudrate * self.rig.time_scale        # 8N1: 10 bits per byte
+
+    def schedule(self, data, start):
+        """Makes `data` arrive byte by byte, the first one at `start`"""
+        if self.incoming:
+            start = max(start, self.incoming[-1][0] + self.byte_time())
+        for i, byte in enumerate(bytearray(data)):
+            self.incoming.append((start + i*self.byte_time(), byte))
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def isOpen(self):
+        return self.is_open
+
+    @property
+    def in_waiting(self):
+        now = time.time()
+        return sum(1 for t, _ in self.incoming if t <= now)
+
+    def reset_input_buffer(self):
+        now = time.time()
+        while self.incoming and self.incoming[0][0] <= now:
+            self.incoming.popleft()
+
+    def read(self, size=1):
+        t0 = time.time()
+        deadline = float("inf") if self.timeout is None else t0 + self.timeout
+        out = bytearray()
+        last = None
+        while len(out) < size:
+            now = time.time()
+            while self.incoming and self.incoming[0][0] <= now and len(out) < size:
+                last, byte = self.incoming.popleft()
+                out.append(byte)
+            if len(out) >= size:
+                break
+
+            limit = deadline
+            if out and self.inter_byte_timeout is not None:
+                limit = min(limit, last + self.inter_byte_timeout)
+            arrival = self.incoming[0][0] if self.incoming else float("inf")
+            if arrival > limit:
+                if limit > now and limit != float("inf"):
+                    time.sleep(limit - now)
+                break
+            time.sleep(min(max(0.0, arrival - now), POLL_INTERVAL))
+        return bytes(out)
+
+    def read_until(self, expected=b"\n", size=None):
+        data = b""
+        t0 = time.time()
+        timeout = self.timeout
+        try:
+            while not data.endswith(expected) and (size is None or len(data) < size):
+                if timeout is not None:
+                    self.timeout = timeout - (time.time() - t0)
+                    if self.timeout <= 0:
+                        break
+                byte = self.read(1)
+                if not byte:
+                    break
+                data += byte
+        finally:
+            self.timeout = timeout
+        return data
+
+
+class _SimAxis(object):
+    """One motor, moving along a trapezoidal velocity profile."""
+    def __init__(self, rig, vmax, accel):
+        self.rig = rig
+        self.vmax = float(vmax)
+        self.accel = float(accel)
+        self.start, self.target = 0, 0
+        self.t0, self.duration = 0.0, 0.0
+        self.velocity = None            # for ROR/ROL
+
+    def move_to(self, target, now):
+        self.start = self.position(now)
+        self.target = target
+        self.velocity = None
+        self.t0 = now
+        self.duration = self.move_time(abs(target - self.start))
+
+    def rotate(self, velocity, now):
+        self.start = self.position(now)
+        self.target = self.start
+        self.velocity = velocity
+        self.t0 = now
+
+    def stop(self, now):
+        self.move_to(self.position(now), now)
+        self.duration = 0.0
+
+    def move_time(self, d):
+        v, a = self.vmax, self.accel
+        if d < v*v/a:
+            t = 2*math.sqrt(d/a)
+        else:
+            t = d/v + v/a
+        return t * self.rig.time_scale
+
+    def position(self, now):
+        t = (now - self.t0) / self.rig.time_scale
+        if self.velocity is not None:
+            return int(self.start + self.velocity*t)
+
+        d = abs(self.target - self.start)
+        T = self.duration / self.rig.time_scale
+        if t >= T:
+            return self.target
+        v, a = self.vmax, self.accel
+        ta = min(v/a, T/2)
+        if t < ta:
+            s = 0.5*a*t*t
+        elif t < T - ta:
+            s = 0.5*a*ta*ta + a*ta*(t - ta)
+        else:
+            s = d - 0.5*a*(T - t)**2
+        return int(self.start + math.copysign(min(s, d), self.target - self.start))
+
+    def reached(self, now):
+        return self.velocity is None and now >= self.t0 + self.duration
+
+
+class SimTablePort(_SimPort):
+    """TMCL module on a serial line; answers every 9-byte request."""
+    def __init__(self, rig, baudrate, vmax, accel, processing):
+        _SimPort.__init__(self, rig, baudrate)
+        self.axes = dict((axis.value, _SimAxis(rig, vmax[i], accel[i]))
+                         for i, axis in enumerate((Axis.x, Axis.y, Axis.z)))
+        self.processing = processing
+        self.pending = bytearray()
+
+    def write(self, data):
+        self.pending += bytearray(data)
+        done = time.time() + len(data)*self.byte_time()     # when the last byte is in
+        while len(self.pending) >= 9:
+            request, self.pending = self.pending[:9], self.pending[9:]
+            _, cmd, type, motor, value = struct.unpack(">BBBBi", bytes(request[:8]))
+            value = self.execute(cmd, type, motor, value, done)
+            reply = bytearray(struct.pack(">BBBBi", 2, 1, 100, cmd, value))
+            reply.append(sum(reply) % 256)
+            self.schedule(reply, done + self.processing*self.rig.time_scale)
+        return len(data)
+
+    def execute(self, cmd, type, motor, value, now):
+        axis = self.axes[motor]
+        if cmd == Command.MVP.value:
+            axis.move_to(value, now)
+        elif cmd == Command.ROR.value:
+            axis.rotate(-value, now)
+        elif cmd == Command.ROL.value:
+            axis.rotate(value, now)
+        elif cmd == Command.MST.value:
+            axis.stop(now)
+        elif cmd == Command.GAP.value:
+            if type == AxisParameter.actual_pos.value:  return axis.position(now)
+            if type == AxisParameter.target_pos.value:  return axis.target
+            if type == AxisParameter.pos_reached.value: return int(axis.reached(now))
+            if type == AxisParameter.max_accel.value:   return int(axis.accel)
+        return 0
+
+    def position(self, now=None):
+        now = time.time() if now is None else now
+        return Point(*[self.axes[axis.value].position(now) for axis in (Axis.x, Axis.y, Axis.z)])
+
+
+class SimTargetPort(_SimPort):
+    """The target board's serial line.
+
+    On STARTBYTE, the board runs its computation; if the glitcher is
+    armed, it plays its next pattern, and the fault map decides whether
+    the board answers correctly, with a faulty response, or goes silent
+    until it's reset.
+    """
+    def __init__(self, rig, baudrate, latency):
+        _SimPort.__init__(self, rig, baudrate)
+        self.timeout = TIMEOUT          # as `vcg.VCG` opens the real port
+        self.latency = latency
+        self.alive = True
+        self.ready_at = 0.0
+
+    def write(self, data):
+        now = time.time()
+        for byte in bytearray(data):
+            if byte == bytearray(STARTBYTE)[0] and self.alive and now >= self.ready_at:
+                self.run(now)
+        return len(data)
+
+    def run(self, now):
+        outcome = self.rig.glitcher.trigger(now)
+        start = now + self.latency*self.rig.time_scale
+        if outcome == "NORMAL":
+            self.schedule(RESPONSE_CORRECT, start)
+        elif outcome == "JUSTRIGHT":
+            response = bytearray(RESPONSE_CORRECT)
+            flipped = self.rig.rng.randint(0, RESPLEN, size=self.rig.rng.randint(1, 8))
+            for i in flipped:
+                response[i] ^= 1 + self.rig.rng.randint(255)
+            self.schedule(bytes(response), start)
+        else:
+            self.alive = False
+
+    def reset(self, now):
+        self.incoming.clear()
+        self.alive = True
+        self.ready_at = now + self.rig.boot_time*self.rig.time_scale
+        if self.rig.boot_banner:
+            self.schedule(self.rig.boot_banner, self.ready_at)
+
+
+class SimGlitcher(object):
+    """Stands in for `vcglitcher.VCGlitcher`; implements the calls `vcg.VCG` makes."""
+    def __init__(self, rig):
+        self.rig = rig
+        self.staged = []
+        self.patterns = []
+        self.next_pattern = 0
+        self.amplitude = AMPLITUDE_LO
+        self.armed = False
+        self.busy_until = 0.0
+        self.stuck = False
+        self.reset_low_at = None
+
+    def _usb(self):
+        time.sleep(self.rig.usb_latency * self.rig.time_scale)
+
+    # setup
+    def device_list(self):                          self._usb()
+    def device_get_info(self, i):                   self._usb()
+    def open(self):                                 self._usb()
+    def close(self):                                pass
+    def set_mode(self, mode):                       self._usb()
+    def smartcard_reset_config(self, src, pol):     self._usb()
+    def evcg_trigger_config(self, src, edge):       self._usb()
+
+    def evcg_get_guaranteed_pattern_number(self):
+        self._usb()
+        return self.rig.n_patterns
+
+    # patterns
+    def evcg_clear_pattern(self):
+        self._usb()
+        self.staged = []
+
+    def evcg_add_glitch(self, offset, duration, repeat):
+        self._usb()
+        assert len(self.staged) < self.rig.n_patterns, "too many patterns"
+        self.staged.append((offset, duration, repeat))
+
+    def evcg_set_pattern(self):
+        self._usb()
+        self.patterns = list(self.staged)
+        self.next_pattern = 0
+
+    def set_laser_glitch_parameter(self, v_amplitude, v_vcc_clk):
+        self._usb()
+        self.amplitude = v_amplitude
+
+    def evcg_set_arm(self, arm):
+        self._usb()
+        self.armed = arm
+        self.next_pattern = 0
+        self.stuck = False
+
+    def evcg_busy(self):
+        self._usb()
+        return self.stuck or time.time() < self.busy_until
+
+    # resets
+    def set_smartcard_soft_reset(self, level):
+        self._usb()
+        now = time.time()
+        if level == 0:
+            self.reset_low_at = now
+        elif self.reset_low_at is not None:
+            if now - self.reset_low_at >= self.rig.min_reset_pulse*self.rig.time_scale:
+                self.rig.target_port.reset(now)
+            self.reset_low_at = None
+
+    def trigger(self, now):
+        """The board asked for a glitch; returns the outcome of the run."""
+        if not self.armed or not self.patterns:
+            return "NORMAL"
+
+        offset, duration, repeat = self.patterns[self.next_pattern % len(self.patterns)]
+        self.next_pattern += 1
+        glitch_time = (offset + duration*repeat) * 2e-9          # in units of 2ns
+        self.busy_until = now + (glitch_time + self.rig.busy_overhead) * self.rig.time_scale
+        if self.rig.rng.random_sample() < self.rig.p_stuck:
+            self.stuck = True
+
+        x, y = self.rig.probe_position(now)
+        intensity = (self.amplitude - AMPLITUDE_LO) / (AMPLITUDE_HI - AMPLITUDE_LO)
+        p = self.rig.fault_map.probabilities(x, y, intensity, offset, repeat)
+        return ["NORMAL", "JUSTRIGHT", "RESET"][self.rig.rng.choice(3, p=np.array(p)/sum(p))]
+
+
+class SimRig(object):
+    """The simulated rig: a table, a glitcher and a board, sharing one clock.
+
+    All times are in seconds, multiplied by `time_scale`
+    (e.g. 0.1 runs ten times faster than the real thing).
+    """
+    def __init__(self, fault_map=None, seed=0, time_scale=1.0,
+                 table_baud=9600, target_baud=115200,
+                 vmax=(20000, 20000, 5000), accel=(100000, 100000, 20000),     # x, y, z
+                 tmcl_processing=0.001,
+                 chip=((0, 0, 0), (40000, 0, 0), (40000, 40000, 0)),
+                 usb_latency=0.0005, n_patterns=8, busy_overhead=0.0005, p_stuck=0.001,
+                 response_latency=0.001, min_reset_pulse=0.001, boot_time=0.002, boot_banner=b""):
+
+        self.fault_map  = fault_map or FaultMap(seed)
+        self.rng        = np.random.RandomState(seed)
+        self.time_scale = time_scale
+
+        self.usb_latency     = usb_latency
+        self.n_patterns      = n_patterns
+        self.busy_overhead   = busy_overhead
+        self.p_stuck         = p_stuck
+        self.min_reset_pulse = min_reset_pulse
+        self.boot_time       = boot_time
+        self.boot_banner     = boot_banner
+
+        self.origin, self.xpoint, self.ypoint = [Point(*c) for c in chip]
+
+        self.table_port  = SimTablePort(self, table_baud, vmax, accel, tmcl_processing)
+        self.target_port = SimTargetPort(self, target_baud, response_latency)
+        self.glitcher    = SimGlitcher(self)
+
+        # the enums `vcg.VCG` takes from the backend; their values don't matter here
+        class _Enum(object):
+            def __getattr__(self, name):
+                return name
+        self.GLITCH_MODE = self.RST_SRC = self.EVCG_RST_POLARITY = _Enum()
+        self.EVCG_TRIGGER_SRC = self.EVCG_TRIGGER_EDGE = _Enum()
+
+    def VCGlitcher(self):
+        return self.glitcher
+
+    def make_table(self):
+        """Returns an `XYTable` on the simulated port, with the chip's corners set."""
+        table = XYTable(ser=self.table_port)
+        table.origin, table.xpoint, table.ypoint = self.origin, self.xpoint, self.ypoint
+        return table
+
+    def make_vcg(self, **kwargs):
+        """Returns a `vcg.VCG` using the simulated glitcher and board."""
+        from vcg import VCG
+        return VCG(backend=self, ser=self.target_port, **kwargs)
+
+    def probe_position(self, now=None):
+        """Where the probe is, in chip coordinates (x, y in [0,1])"""
+        p = (self.table_port.position(now) - self.origin).as_array().astype(float)
+        A = np.vstack(((self.xpoint - self.origin).as_array(),
+                       (self.ypoint - self.xpoint).as_array(),
+                       (0.0, 0.0, 1.0))).T
+        x, y, _ = np.linalg.solve(A, p)
+        return x, y
@@ -0,0 +1,170 @@
+from __future__ import print_function, division
+import itertools
+import numpy as np
+
+from unit import OFFSET_MIN, OFFSET_RANGE
+
+
+def coords(unit):
+    """The unit's position in the 4-D space of `Unit.distance_to`"""
+    return (unit.x, unit.y, unit.intensity, (unit.offset - OFFSET_MIN) / float(OFFSET_RANGE))
+
+
+class _Bucket(object):
+    """The units in one cell, with their coordinates as an array (made on demand)"""
+    def __init__(self):
+        self.coords = []
+        self.units  = []
+        self.array  = None
+
+    def add(self, c, unit):
+        self.coords.append(c)
+        self.units.append(unit)
+        self.array = None
+
+    def remove(self, unit):
+        i = next(i for i, u in enumerate(self.units) if u is unit)
+        del self.coords[i], self.units[i]
+        self.array = None
+
+    def distances(self, q):
+        if self.array is None:
+            self.array = np.array(self.coords, dtype=float)
+        return np.sqrt(((self.array - q)**2).sum(axis=1))
+
+
+class SpatialIndex(object):
+    """Uniform grid over (x, y, intensity, offset), with one grid per unit type.
+
+    Units are filed under their type when added; `update` re-files a unit
+    whose type has changed. Queries only visit the cells near the query
+    point (and only the grids of the requested types), so they take time
+    proportional to the number of units nearby, not in the whole index.
+    Distances are those of `Unit.distance_to`.
+    """
+    def __init__(self, cell_size=0.1):
+        self.cell_size = cell_size
+        self.grids = {}         # type -> {cell: _Bucket}
+        self.filed = {}         # id(unit) -> (type, cell)
+        self.by_type = {}       # type -> {id(unit): unit}, in insertion order of the cache
+        self.rings = {}         # radius -> cell offsets at that Chebyshev distance
+
+    def __len__(self):
+        return len(self.filed)
+
+    def cell(self, c):
+        return tuple(int(v // self.cell_size) for v in c)
+
+    def add(self, unit):
+        c = coords(unit)
+        cell = self.cell(c)
+        grid = self.grids.setdefault(unit.type, {})
+        if cell not in grid:
+            grid[cell] = _Bucket()
+        grid[cell].add(c, unit)
+        self.by_type.setdefault(unit.type, {})[id(unit)] = unit
+        self.filed[id(unit)] = (unit.type, cell)
+
+    def remove(self, unit):
+        type, cell = self.filed.pop(id(unit))
+        bucket = self.grids[type][cell]
+        bucket.remove(unit)
+        if not bucket.units:
+            del self.grids[type][cell]
+        del self.by_type[type][id(unit)]
+
+    def update(self, unit):
+        """Adds `unit`, or re-files it if its type has changed since."""
+        if id(unit) in self.filed:
+            if self.filed[id(unit)] == (unit.type, self.cell(coords(unit))):
+                return
+            self.remove(unit)
+        self.add(unit)
+
+    def clear(self):
+        self.grids.clear()
+        self.filed.clear()
+        self.by_type.clear()
+
+    def of_type(self, type):
+        """All the units of `type`, in the order they were added"""
+        return list(self.by_type.get(type, {}).values())
+
+
+    def _grids(self, types):
+        if types is None:
+            return list(self.grids.values())
+        return [self.grids[t] for t in types if t in self.grids]
+
+    def _ring(self, r):
+        if r not in self.rings:
+            self.rings[r] = [d for d in itertools.product(range(-r, r+1), repeat=4)
+                             if max(abs(v) for v in d) == r]
+        return self.rings[r]
+
+
+    def within(self, unit, radius, types=None):
+        """The units (of `types`, if given) within `radius` of `unit`"""
+        q = np.array(coords(unit))
+        lo = self.cell([v - radius for v in q])
+        hi = self.cell([v + radius for v in q])
+        out = []
+        for grid in self._grids(types):
+            if not grid:
+                continue
+            n_cells = 1
+            for a, b in zip(lo, hi):
+                n_cells *= b - a + 1
+            if n_cells <= len(grid):
+                buckets = (grid.get(cell) for cell in itertools.product(*[range(a, b+1) for a, b in zip(lo, hi)]))
+            else:       # sparse grid: cheaper to check its cells
+                buckets = (b for cell, b in grid.items() if all(l <= v <= h for v, l, h in zip(cell, lo, hi)))
+            for bucket in buckets:
+                if bucket:
+                    inside = np.flatnonzero(bucket.distances(q) <= radius)
+                    out += [bucket.units[i] for i in inside]
+        return out
+
+
+    def nearest(self, unit, k=1, types=None):
+        """The `k` units (of `types`, if given) nearest to `unit`, nearest first,
+        as a list of (distance, unit)."""
+        q = np.array(coords(unit))
+        center = self.cell(q)
+        grids = [g for g in self._grids(types) if g]
+        n_cells = sum(len(g) for g in grids)
+        distances, units = [], []
+
+        def visit(bucket):
+            distances.append(bucket.distances(q))
+            units.extend(bucket.units)
+
+        r = 0
+        while n_cells:
+            if (2*r + 1)**4 >= n_cells:
+                # the rings would visit more cells than there are: check them all
+                del distances[:], units[:]
+                for g in grids:
+                    for bucket in g.values():
+                        visit(bucket)
+                break
+            for d in self._ring(r):
+                cell = tuple(a + b for a, b in zip(center, d))
+                for g in grids:
+                    if cell in g:
+                        visit(g[cell])
+            # the cells not visited yet are outside the box of rings 0..r
+            lo = (np.array(center) - r) * self.cell_size
+            hi = (np.array(center) + r + 1) * self.cell_size
+            bound = min((q - lo).min(), (hi - q).min())
+            if len(units) >= k:
+                distances = [np.concatenate(distances)]
+                if np.partition(distances[0], k-1)[k-1] <= bound:
+                    break
+            r += 1
+
+        if not units:
+            return []
+        distances = np.concatenate(distances)
+        best = np.argsort(distances, kind="mergesort")[:k]
+        return [(float(distances[i]), units[i]) for i in best]
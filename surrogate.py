@@ -0,0 +1,97 @@
+from __future__ import print_function, division
+import itertools
+import numpy as np
+
+from unit import OFFSET_MIN, OFFSET_RANGE
+
+TYPES = ["NORMAL", "RESET", "JUSTRIGHT", "CHANGING"]
+
+
+class Surrogate(object):
+    """Cheap model of the measurement outcomes, fit on the cache.
+
+    The (x, y, intensity, offset) space is cut into a grid of `bins`^4
+    cells, and each cell counts the types of the cached units in it.
+    A candidate's class probabilities are the counts in its cell and the
+    cells around it, smoothed towards the overall class frequencies (as
+    if `prior_weight` units of those frequencies were there too).
+    Its expected fitness uses the mean fitness of each class so far.
+
+    `update` only adds the units cached since the last call (and `add`
+    the units given), so refitting costs little, and `score` works on
+    whole arrays of candidates.
+    """
+    def __init__(self, bins=10, prior_weight=1.0, exploration=1.0):
+        self.bins = bins
+        self.prior_weight = prior_weight
+        self.exploration  = exploration         # weight of the uncertainty in `score`
+        self.counts  = np.zeros((bins,)*4 + (len(TYPES),))
+        self.fitness = np.zeros(len(TYPES))     # total fitness per type
+        self.seen = 0                           # units of the cache fit so far
+        self.smoothed = None
+
+
+    def cells(self, x, y, intensity, offset):
+        """Grid indices of the given parameters (arrays)"""
+        o = (np.asarray(offset, dtype=float) - OFFSET_MIN) / OFFSET_RANGE
+        return tuple(np.clip((np.asarray(v, dtype=float)*self.bins).astype(int), 0, self.bins-1)
+                     for v in (x, y, intensity, o))
+
+
+    def update(self, cache):
+        """Adds the units cached since the last update.
+
+        The cache mustn't change meanwhile: while another thread is adding
+        to it, `add` the evaluated units as they come instead.
+        """
+        new = list(itertools.islice(cache, self.seen, None))
+        self.seen += len(new)
+        self.add(new)
+
+
+    def add(self, units):
+        """Adds evaluated units."""
+        new = [u for u in units if u.type in TYPES]
+        if not new:
+            return
+        types = np.array([TYPES.index(u.type) for u in new])
+        cells = self.cells([u.x for u in new], [u.y for u in new],
+                           [u.intensity for u in new], [u.offset for u in new])
+        np.add.at(self.counts, cells + (types,), 1)
+        np.add.at(self.fitness, types, [u.fitness for u in new])
+        self.smoothed = None
+
+
+    def _smooth(self):
+        """Sums the counts of every cell and its neighbours"""
+        padded = np.pad(self.counts, [(1, 1)]*4 + [(0, 0)], mode="constant")
+        n = self.bins
+        out = np.zeros_like(self.counts)
+        for d in itertools.product(range(3), repeat=4):
+            out += padded[d[0]:d[0]+n, d[1]:d[1]+n, d[2]:d[2]+n, d[3]:d[3]+n]
+        return out
+
+
+    def probabilities(self, x, y, intensity, offset):
+        """Class probabilities of the candidates, as an (N, len(TYPES)) array"""
+        if self.smoothed is None:
+            self.smoothed = self._smooth()
+        local = self.smoothed[self.cells(x, y, intensity, offset)]
+        totals = self.counts.reshape(-1, len(TYPES)).sum(axis=0)
+        prior = (totals + 1.0) / (totals.sum() + len(TYPES))
+        return (local + self.prior_weight*prior) / (local.sum(axis=1, keepdims=True) + self.prior_weight)
+
+
+    def score(self, population):
+        """Acquisition value of the candidates of a `Population`: the expected
+        fitness plus `exploration` times its spread, shrinking with the evidence."""
+        p = self.probabilities(population.x, population.y, population.intensity, population.offset)
+        totals = self.counts.reshape(-1, len(TYPES)).sum(axis=0)
+        defaults = np.array([2.0, 5.0, 10.0, 4.0])        # as in `ga.classify_unit`
+        f = np.where(totals > 0, self.fitness / np.maximum(totals, 1), defaults)
+
+        mean = p.dot(f)
+        spread = np.sqrt(np.maximum(p.dot(f**2) - mean**2, 0.0))
+        evidence = self.smoothed[self.cells(population.x, population.y,
+                                            population.intensity, population.offset)].sum(axis=1)
+        return mean + self.exploration * spread / np.sqrt(1.0 + evidence)
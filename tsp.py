@@ -1,4 +1,5 @@
 import numpy as np
+import time
 
 def total_distance(solution, cities, norm="euclidean", cycle=False):
     """Calculates the total distance between cities for the given ordering.
@@ -22,7 +23,32 @@ def total_distance(solution, cities, norm="euclidean", cycle=False):
 
 
 
-def tsp_greedy(cities, norm="euclidean"):
+def distance_matrix(cities, norm="euclidean"):
+    """Returns the matrix of pairwise distances between the cities.
+
+    `norm` parameters are the same as for `total_distance`.
+    """
+    cities = np.asarray(cities, dtype=float)
+    assert len(cities.shape)==2
+
+    diff = np.abs(cities[:, None, :] - cities[None, :, :])
+    if norm == "euclidean": return np.sqrt((diff**2).sum(axis=2))
+    elif norm == "max"    : return diff.max(axis=2)
+    else: raise ValueError("Invalid value for parameter `norm`: " + str(norm))
+
+
+
+def tour_length(tour, dist, cycle=False):
+    """Length of `tour` over the precomputed distance matrix `dist`."""
+    tour = np.asarray(tour)
+    length = dist[tour[:-1], tour[1:]].sum()
+    if cycle and len(tour) > 1:
+        length += dist[tour[-1], tour[0]]
+    return length
+
+
+
+def tsp_greedy(cities, norm="euclidean", dist=None):
     """Finds a greedy solution to the TSP, starting from the first city
     in the list given.
 
@@ -30,24 +56,21 @@ def tsp_greedy(cities, norm="euclidean"):
     separate parameters for this.
 
     `norm` parameters are the same as for `total_distance`.
+    If given, `dist` is used as the distance matrix instead of `norm`.
     """
-    if norm == "euclidean": norm = np.linalg.norm
-    elif norm == "max"    : norm = max
-    else: raise ValueError("Invalid value for parameter `norm`: " + str(norm))
-
-    cities = np.array(cities)
-    assert len(cities.shape)==2
+    if dist is None:
+        dist = distance_matrix(cities, norm)
 
-    point = list(range(len(cities)))
+    N = len(dist)
+    visited = np.zeros(N, dtype=bool)
 
     path = [0]
-    remaining = list(range(1, len(cities)))
-    while remaining:
-        curr = path[-1]
-        nearest = sorted([(norm(cities[curr] - cities[i]), i) for i in remaining])
-        nearest = nearest[0][1]
+    visited[0] = True
+    for _ in range(N-1):
+        row = np.where(visited, np.inf, dist[path[-1]])
+        nearest = int(row.argmin())
         path.append(nearest)
-        remaining.remove(nearest)
+        visited[nearest] = True
 
     return path
 
@@ -60,61 +83,294 @@ def swap_2opt(tour, i, j):
 
 
 
-def tsp_2opt(cities, init=None, cycle=False):
-    """Returns a 2-optimal tour over the cities.
+def improve_2opt(tour, dist, cycle=False, deadline=None):
+    """Applies improving 2-opt swaps to `tour` (an np.ndarray), in place,
+    until it is 2-optimal or `deadline` (a `time.time()` value) has passed.
 
-    If given, `init` is used for the starting point.
+    Every candidate swap is scored from the (at most) four edges it changes.
+    For each node i we apply the best swap starting at i, and sweep until
+    no improving swap is left. The first node is never moved.
+
+    Returns `True` if the tour was improved.
     """
+    N = len(tour)
+    any_improved = False
 
-    cities = np.array(cities)
-    assert len(cities.shape)==2
+    improved = N >= 3
+    while improved:
+        improved = False
+
+        for i in range(1, N-1):
+            # reversing tour[i..j] replaces edges (a,b), (c,d)
+            #                          with edges (a,c), (b,d)
+            a = tour[i-1]
+            b = tour[i]
+            c = tour[i+1:]
+            d = tour[i+2:]
+
+            delta = dist[a, c] - dist[a, b]
+            delta[:-1] += dist[b, d] - dist[c[:-1], d]
+
+            # the last node only has an outgoing edge if we're on a cycle
+            if cycle:
+                delta[-1] += dist[b, tour[0]] - dist[c[-1], tour[0]]
 
-    if init: tour = init
-    else:    tour = list(range(len(cities)))
+            k = int(delta.argmin())
+            if delta[k] < -1e-9:
+                j = i+1 + k
+                tour[i:j+1] = tour[i:j+1][::-1]
+                improved = any_improved = True
 
-    bestdist = total_distance(tour, cities, cycle=True)
+        if deadline is not None and time.time() > deadline:
+            break
 
-    # Try the 2-opt swap for every pair of edges.
-    # When there's no improving swaps left, the tour is 2-optimal.
-    improved = True
+    return any_improved
+
+
+
+def improve_oropt(tour, dist, cycle=False, deadline=None, max_segment=3):
+    """Applies improving Or-opt moves to `tour` (an np.ndarray), in place,
+    until none are left or `deadline` has passed.
+
+    An Or-opt move takes a segment of up to `max_segment` consecutive nodes
+    and reinserts it elsewhere in the tour, either as-is or reversed
+    (the reversed variant is a restricted 3-opt move).
+    The first node is never moved.
+
+    Returns `True` if the tour was improved.
+    """
+    N = len(tour)
+    any_improved = False
+
+    improved = N >= 4
     while improved:
         improved = False
 
-        # if we're optimizing a path, we don't touch the first node
-        start = 0 if cycle else 1
+        for L in range(1, max_segment+1):
+            i = 1
+            while i + L <= N:
+                seg = tour[i:i+L]
+                s0, sL = seg[0], seg[-1]
+                p = tour[i-1]
+
+                # gain from cutting the segment out
+                if i + L < N:
+                    n = tour[i+L]
+                    removed = dist[p, s0] + dist[sL, n] - dist[p, n]
+                elif cycle:
+                    n = tour[0]
+                    removed = dist[p, s0] + dist[sL, n] - dist[p, n]
+                else:
+                    removed = dist[p, s0]
+
+                # cost of inserting it between rest[k] and rest[k+1]
+                rest = np.concatenate((tour[:i], tour[i+L:]))
+                if cycle:
+                    nxt = np.roll(rest, -1)
+                    old = dist[rest, nxt]
+                    fwd = dist[rest, s0] + dist[sL, nxt] - old
+                    rev = dist[rest, sL] + dist[s0, nxt] - old
+                else:
+                    nxt = rest[1:]
+                    old = dist[rest[:-1], nxt]
+                    fwd = np.append(dist[rest[:-1], s0] + dist[sL, nxt] - old, dist[rest[-1], s0])
+                    rev = np.append(dist[rest[:-1], sL] + dist[s0, nxt] - old, dist[rest[-1], sL])
+
+                k_fwd = int(fwd.argmin())
+                k_rev = int(rev.argmin())
+                if rev[k_rev] < fwd[k_fwd]:
+                    k, added, seg = k_rev, rev[k_rev], seg[::-1]
+                else:
+                    k, added = k_fwd, fwd[k_fwd]
+
+                if added - removed < -1e-9:
+                    tour[:] = np.concatenate((rest[:k+1], seg, rest[k+1:]))
+                    improved = any_improved = True
+                i += 1
+
+            if deadline is not None and time.time() > deadline:
+                return any_improved
+
+    return any_improved
+
+
+
+def perturb_double_bridge(tour, rng=np.random):
+    """Returns a copy of `tour` with a random double-bridge move applied
+    (the classic Lin-Kernighan kick, which 2-opt and Or-opt can't undo).
+    The first node stays in place.
+    """
+    N = len(tour)
+    p1, p2, p3 = sorted(rng.choice(np.arange(1, N), size=3, replace=False))
+    return np.concatenate((tour[:p1], tour[p2:p3], tour[p1:p2], tour[p3:]))
+
+
+LOCAL_SEARCH_MOVES = (improve_2opt, improve_oropt)
+
+def tsp_local_search(cities, init=None, cycle=False, norm="euclidean", dist=None,
+                     moves=LOCAL_SEARCH_MOVES, time_budget=None, seed=None):
+    """Returns a locally optimal tour over the cities.
+
+    Args:
+        init        -- if given, used for the starting point
+        dist        -- if given, used as the distance matrix instead of `norm`
+        moves       -- the improvement functions to use, as `improve_2opt`
+        time_budget -- wall-clock seconds to spend; if `None`, we stop at the
+                       first local optimum, otherwise we keep kicking the best
+                       tour with double-bridge moves (iterated local search)
+                       until the budget runs out
+        seed        -- seed for the kicks
+    """
+    if dist is None:
+        dist = distance_matrix(cities, norm)
+    N = len(dist)
+    deadline = None if time_budget is None else time.time() + time_budget
+
+    def descend(tour):
+        improved = True
+        while improved:
+            improved = False
+            for move in moves:
+                improved |= move(tour, dist, cycle=cycle, deadline=deadline)
+            if deadline is not None and time.time() > deadline:
+                break
 
-        for i in range(start,len(cities)):
-            for j in range(i+1, len(cities)):
-                candidate = swap_2opt(tour, i, j)
-                newdist = total_distance(candidate, cities, cycle=True)
+    if init: best = np.array(init)
+    else:    best = np.arange(N)
 
-                if newdist < bestdist:
-                    tour = candidate
-                    bestdist = newdist
-                    improved = True
-                    break
+    descend(best)
+    bestlen = tour_length(best, dist, cycle)
 
-            if improved: break
+    if deadline is not None and N >= 8:
+        rng = np.random.RandomState(seed)
+        while time.time() < deadline:
+            candidate = perturb_double_bridge(best, rng)
+            descend(candidate)
+            length = tour_length(candidate, dist, cycle)
+            if length < bestlen:
+                best, bestlen = candidate, length
 
-    return tour
+    return list(best)
 
 
-def find_shortest_hamilton_path_XYZ(uncached_solutions, table):
-    """Finds shortest Hamilton path in the XYZ-table parameter space, with max-norm as distance.
-        
-        Since all motors are roughly the same speed, max-norm corresponds
-        to actual time taken.
 
-        Uses a greedy algorithm, followed by 2-opt.
+def tsp_2opt(cities, init=None, cycle=False, norm="euclidean", dist=None):
+    """Returns a 2-optimal tour over the cities.
+
+    If given, `init` is used for the starting point.
+    If given, `dist` is used as the distance matrix instead of `norm`.
     """
+    return tsp_local_search(cities, init=init, cycle=cycle, norm=norm, dist=dist,
+                            moves=(improve_2opt,))
+
+
+def nearest_neighbour_order(points, start=0):
+    """Yields the indices of `points` (an (N, 2) array-like within [0,1]^2)
+    in nearest-neighbour order (euclidean), beginning with `start`.
 
-    cities = [table.get_position()] + [table.gen2coord(u.x, u.y) for u in uncached_solutions]
+    The points are kept in a bucket grid with deletion, so every step only
+    looks at the cells around the current point; the grid is rebuilt with
+    coarser cells as it empties. Since it's a generator, the first indices
+    are available right away, and the rest are planned as they're consumed.
+    """
+    points = np.asarray(points, dtype=float)
+    assert len(points.shape)==2 and points.shape[1]==2
+    N = len(points)
+    if N == 0:
+        return
+
+    xs = points[:, 0].tolist()
+    ys = points[:, 1].tolist()
+
+    def build(indices):
+        indices = np.asarray(indices, dtype=int)
+        G = max(1, int(np.sqrt(len(indices)/2.0)))
+        cx = np.clip((points[indices, 0]*G).astype(int), 0, G-1)
+        cy = np.clip((points[indices, 1]*G).astype(int), 0, G-1)
+        order = np.argsort(cx*G + cy, kind="stable")
+        bounds = np.searchsorted((cx*G + cy)[order], np.arange(G*G+1))
+        flat = indices[order].tolist()
+        cells = [[flat[bounds[a*G+b]:bounds[a*G+b+1]] for b in range(G)] for a in range(G)]
+        where = dict(zip(indices.tolist(), zip(cx.tolist(), cy.tolist())))
+        return G, cells, where
+
+    G, cells, where = build(np.arange(N))
+    remaining = N
+
+    curr = start
+    while True:
+        cx, cy = where.pop(curr)
+        cells[cx][cy].remove(curr)
+        remaining -= 1
+        yield curr
+
+        if not remaining:
+            return
+        if remaining < G*G // 8:
+            G, cells, where = build(list(where))
+            cx = min(max(int(xs[curr]*G), 0), G-1)
+            cy = min(max(int(ys[curr]*G), 0), G-1)
+
+        # search rings of cells around the current one, until no
+        # unvisited cell can hold anything closer than the best so far
+        x, y = xs[curr], ys[curr]
+        best, bestdist = None, float("inf")
+        r = 0
+        while r <= G:
+            for i in range(max(cx-r, 0), min(cx+r, G-1)+1):
+                edge = (i == cx-r or i == cx+r)
+                for j in (range(max(cy-r, 0), min(cy+r, G-1)+1) if edge else (cy-r, cy+r)):
+                    if not 0 <= j < G:
+                        continue
+                    for k in cells[i][j]:
+                        d = (xs[k]-x)**2 + (ys[k]-y)**2
+                        if d < bestdist:
+                            best, bestdist = k, d
+            if best is not None and bestdist <= (r/float(G))**2:
+                break
+            r += 1
+        curr = best
+
+
+
+def find_shortest_hamilton_path_XYZ(uncached_solutions, table, time_budget=None, start=None):
+    """Finds shortest Hamilton path in the XYZ-table parameter space.
+
+        If the table has a calibrated `motion_model`, the distance is the
+        predicted travel time in seconds. Otherwise we use the max-norm:
+        since all motors are roughly the same speed, it roughly
+        corresponds to the time taken.
+
+        Uses a greedy algorithm, followed by 2-opt and Or-opt local search.
+
+        `time_budget` bounds the time spent optimizing: either seconds,
+        or a function from the greedy path's length to seconds
+        (e.g. `lambda length: 0.05*length` for 5% of the travel time,
+        when a motion model is used).
+        The best path found within the budget is returned.
+
+        The path starts from Point `start` if given (e.g. when planning
+        ahead of the table), else from the table's current position.
+    """
+
+    if start is None:
+        start = table.get_position()
+    cities = [start] + [table.gen2coord(u.x, u.y) for u in uncached_solutions]
     cities = np.array([(c.x, c.y, c.z) for c in cities])
 
     assert len(cities.shape)==2 and cities.shape[1]==3
 
-    greedy_solution = tsp_greedy(cities, norm="max")
-    solution = tsp_2opt(cities, init=greedy_solution)
+    if table.motion_model:
+        dist = table.motion_model.time_matrix(cities)
+    else:
+        dist = distance_matrix(cities, norm="max")
+    greedy_solution = tsp_greedy(cities, dist=dist)
+
+    if callable(time_budget):
+        time_budget = time_budget(tour_length(greedy_solution, dist))
+
+    solution = tsp_local_search(cities, init=greedy_solution, cycle=False, dist=dist,
+                                time_budget=time_budget)
 
     solution = [x-1 for x in solution][1:]            # remove the current position from result
 
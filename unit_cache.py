@@ -0,0 +1,103 @@
+from __future__ import print_function, division
+from collections import OrderedDict
+import numpy as np
+
+from spatial_index import SpatialIndex
+
+SETUP = ("x", "y", "intensity", "offset", "repetitions")     # the unit's parameters, which key it
+
+
+class UnitCache(OrderedDict):
+    """Cache of evaluated units, {unit: fitness}, keyed on the physical setup.
+
+    Units are looked up by their quantized parameters: x and y are snapped
+    to a grid of `xy_resolution` steps, intensity to `intensity_resolution`
+    steps, and the offset to multiples of `offset_resolution`; repetitions
+    are compared as they are. Units that only differ below the resolution
+    (which the hardware can't tell apart anyway) share the first one's
+    entry; storing one of them copies its evaluation (everything but the
+    setup) onto the unit already cached. A resolution of `None`
+    compares that parameter exactly.
+
+    Iterating gives the units that were actually evaluated. `lookup`
+    counts `hits` and `misses`. The cached units are also kept in a
+    `SpatialIndex`, `spatial`, for neighbourhood queries by type; it's
+    updated whenever a unit is (re-)stored.
+    """
+    def __init__(self, xy_resolution=None, intensity_resolution=None, offset_resolution=None, cell_size=0.1):
+        self.xy_resolution        = xy_resolution
+        self.intensity_resolution = intensity_resolution
+        self.offset_resolution    = offset_resolution
+        self.index = {}         # quantized key -> cached unit
+        self.spatial = SpatialIndex(cell_size)
+        self.hits = self.misses = 0
+        OrderedDict.__init__(self)
+
+    def key(self, unit):
+        snap = lambda value, steps: value if steps is None else int(round(value*steps))
+        return (snap(unit.x, self.xy_resolution),
+                snap(unit.y, self.xy_resolution),
+                snap(unit.intensity, self.intensity_resolution),
+                snap(unit.offset, self.offset_resolution and 1.0/self.offset_resolution),
+                unit.repetitions)
+
+    def keys_of(self, population):
+        """The keys of all the solutions of a `Population`, as an (N, 5) array"""
+        snap = lambda values, steps: values if steps is None else np.round(values*steps)
+        return np.column_stack((snap(population.x, self.xy_resolution),
+                                snap(population.y, self.xy_resolution),
+                                snap(population.intensity, self.intensity_resolution),
+                                snap(population.offset, self.offset_resolution and 1.0/self.offset_resolution),
+                                population.repetitions))
+
+    def lookup(self, unit):
+        """Returns the cached unit with the same physical setup as `unit`, or `None`"""
+        cached = self.index.get(self.key(unit))
+        if cached is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return cached
+
+    def __contains__(self, unit):
+        return self.key(unit) in self.index
+
+    def __getitem__(self, unit):
+        return OrderedDict.__getitem__(self, self.index[self.key(unit)])
+
+    def get(self, unit, default=None):
+        cached = self.index.get(self.key(unit))
+        return default if cached is None else OrderedDict.__getitem__(self, cached)
+
+    def pop(self, unit, *default):
+        if unit not in self:
+            if default:
+                return default[0]
+            raise KeyError(unit)
+        fitness = self[unit]
+        del self[unit]
+        return fitness
+
+    def __setitem__(self, unit, fitness):
+        key = self.key(unit)
+        cached = self.index.get(key)
+        if cached is not None and cached is not unit:
+            # a new evaluation of the same setup goes onto the cached unit
+            for name, value in vars(unit).items():
+                if name not in SETUP:
+                    setattr(cached, name, value)
+            unit = cached
+        OrderedDict.__setitem__(self, unit, fitness)
+        self.index[key] = unit
+        self.spatial.update(unit)
+
+    def __delitem__(self, unit):
+        cached = self.index.pop(self.key(unit))
+        OrderedDict.__delitem__(self, cached)
+        self.spatial.remove(cached)
+
+    def clear(self):
+        OrderedDict.clear(self)
+        self.index.clear()
+        self.spatial.clear()
+        self.hits = self.misses = 0
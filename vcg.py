@@ -2,16 +2,59 @@ from __future__ import print_function, division
 import random
 import serial
 import time
+from collections import deque
+import numpy as np
 
 STARTBYTE = bytearray(b"\x20")
 RESPLEN   = 200
 TIMEOUT   = 0.2
 
-# -9.8 to 4.2
+# Reset timing: how long the reset line is held low, and how long the
+# board may take to come up afterwards (an upper bound if it announces
+# itself by sending BOOT_BANNER on the serial line).
+RESET_PULSE = 0.1
+RESET_READY = 0.01
+BOOT_BANNER = b""
+RESETFILE   = "reset.txt"       # the reset timing found by `calibrate_reset`
+
+# Response reading: the board is declared RESET after this much silence
+# between two bytes, or if the first byte takes longer than FIRST_BYTE_SLACK
+# times the slowest first byte seen so far (but never more than TIMEOUT).
+INTERBYTE_TIMEOUT = 0.005
+FIRST_BYTE_SLACK  = 2.0
+FIRST_BYTE_MIN    = 0.005
+CHUNK             = 20
+
+# glitch amplitude range, and the step it's set in, in volts
+AMPLITUDE_LO = -9.8
+AMPLITUDE_HI =  4.2
+AMPLITUDE_STEP = 0.01
 
 
 EVCG_TIMEOUT_COUNTER = 0
 
+# Waiting for evcg_busy(): the polling schedule and the stuck threshold
+# are learned from the last BUSY_WINDOW completion times (counted from
+# the trigger). We sleep until most glitches are usually done, then poll
+# every BUSY_POLL_FRACTION of the typical spread, and declare the VCG stuck
+# after BUSY_STUCK_FACTOR times the slowest recent completion
+# (never later than BUSY_TIMEOUT, never sooner than BUSY_STUCK_MIN).
+# A completion is timed at the start of the poll that found the VCG idle;
+# if that was the first poll, we only know it was done by then, so it
+# counts as 0. The first poll is learned from the last BUSY_MIN_SAMPLES
+# glitches only; once more than a tenth of those were done by the first
+# poll, it comes BUSY_BACKOFF times sooner.
+BUSY_TIMEOUT       = 0.5
+BUSY_STUCK_MIN     = 0.01
+BUSY_STUCK_FACTOR  = 3.0
+BUSY_POLL_MIN      = 0.0001
+BUSY_POLL_MAX      = 0.005
+BUSY_POLL_FRACTION = 0.05
+BUSY_BACKOFF       = 0.8
+BUSY_WINDOW        = 1000
+BUSY_MIN_SAMPLES   = 50
+BUSY_BINS          = np.logspace(-5, 0, 26)      # histogram bin edges, in seconds
+
 class VCG_ReadTimeout(Exception):
     """Raise when board doesn't respond"""
     pass
@@ -22,12 +65,47 @@ class VCG_BusyTimeout(Exception):
 
 class VCG(object):
 
-    def __init__(self):
+    # Last patterns (offset, duration, repeat) and amplitude pushed to the
+    # glitcher; `glitch` only uploads what has changed since.
+    committed_patterns  = None
+    committed_amplitude = None
+    skipped_uploads     = 0
+    n_patterns          = 1
+
+    reset_pulse = RESET_PULSE
+    reset_ready = RESET_READY
+    boot_banner = BOOT_BANNER
+
+    first_byte_max = None       # slowest first byte of a full response, in seconds
+
+    def __init__(self, cache_state=True, backend=None, ser=None, trace=None):
+        """Opens the glitcher and the board's serial line.
+
+        `backend` is the module providing `VCGlitcher` and its enums
+        (by default, `vcglitcher`), and `ser` the board's serial port
+        (by default, COM6); both can be replaced, e.g. by a `simulator.SimRig`.
+        If a `serial_trace.SerialTrace` is given, the board's traffic is logged into it.
+        """
+
+        self.cache_state = cache_state
 
-        from vcglitcher import (VCGlitcher, GLITCH_MODE, RST_SRC, EVCG_RST_POLARITY,
-                                EVCG_TRIGGER_SRC, EVCG_TRIGGER_EDGE)
+        # (first poll, poll interval, stuck after), in seconds from the trigger
+        self.busy_schedule  = (0.0, BUSY_POLL_MIN, BUSY_TIMEOUT)
+        self.busy_times     = deque(maxlen=BUSY_WINDOW)
+        self.busy_histogram = np.zeros(len(BUSY_BINS)+1, dtype=int)
 
-        self.vcg = VCGlitcher()
+        # per outcome: [count, total seconds, max seconds] spent reading the response
+        self.response_latency = dict((outcome, [0, 0.0, 0.0]) for outcome in ("NORMAL", "JUSTRIGHT", "RESET"))
+
+        if backend is None:
+            import vcglitcher as backend
+        GLITCH_MODE       = backend.GLITCH_MODE
+        RST_SRC           = backend.RST_SRC
+        EVCG_RST_POLARITY = backend.EVCG_RST_POLARITY
+        EVCG_TRIGGER_SRC  = backend.EVCG_TRIGGER_SRC
+        EVCG_TRIGGER_EDGE = backend.EVCG_TRIGGER_EDGE
+
+        self.vcg = backend.VCGlitcher()
         # necessary for opening the VCGlitcher
         self.vcg.device_list()
         self.vcg.device_get_info(0)
@@ -46,9 +124,14 @@ class VCG(object):
             self.vcg.evcg_trigger_config(EVCG_TRIGGER_SRC.TRIGGER_IN, EVCG_TRIGGER_EDGE.RISING)
         
 
-            self.ser = serial.Serial(port = "COM6", baudrate = 115200, parity = serial.PARITY_NONE,
-                                     stopbits = serial.STOPBITS_ONE, bytesize = serial.EIGHTBITS,
-                                     timeout=TIMEOUT)
+            if ser is None:
+                ser = serial.Serial(port = "COM6", baudrate = 115200, parity = serial.PARITY_NONE,
+                                    stopbits = serial.STOPBITS_ONE, bytesize = serial.EIGHTBITS,
+                                    timeout=TIMEOUT)
+            if trace is not None:
+                from serial_trace import TracedSerial
+                ser = TracedSerial(ser, trace, "target")
+            self.ser = ser
             assert self.ser.isOpen()
 
         except Exception as e:
@@ -61,53 +144,253 @@ class VCG(object):
         if self.ser:    self.ser.close()
 
 
-    def glitch(self, intensity, offset, repeat):
+    def glitch(self, intensity, offset, repeat, expected=None):
         """Does one glitch with specified intensity, offset, and repetitions.
-        Returns the board response.
+        Returns the board response; `expected` is the correct response, if known.
         Throws a "Timeout!" exception if it doesn't receive a response.
         """
 
-        # flush any uncommited pattern sequences
-        self.vcg.evcg_clear_pattern()
-
-        # It's possible to add up to n_pattern glitch-patterns:
-        self.vcg.evcg_add_glitch(offset, 40//2, repeat)        # duration must be 40ns
+        self.load_patterns([(offset, repeat)])
         self.set_intensity_level(intensity)
 
         # Play out the pattern:
-        self.vcg.evcg_set_pattern()        # commits patterns into VCG
         self.vcg.evcg_set_arm(True)        # arms the VCG
         self.ser.write(STARTBYTE)
+        t0 = time.time()
+
+        self.wait_busy(t0)              # waits until glitching finishes
+        self.vcg.evcg_set_arm(False)    # disarms the VCG
+
+        response = self.read_response(expected)
+        if response is None:
+            raise VCG_ReadTimeout("board not responding")
+
+        return response
+
+
+    def glitch_batch(self, intensity, patterns, expected=None):
+        """Glitches once for each of the (offset, repetitions) `patterns`,
+        all with the same intensity. Up to `n_patterns` patterns are
+        committed at once and the VCG is armed only once; it plays out
+        the next pattern on every trigger, and we wait for it to be
+        done with each one before reading the board's response.
+
+        This is a generator yielding the board response for each pattern
+        (`None` if the board doesn't respond), so that the caller can reset
+        the board between the shots.
+        Throws VCG_BusyTimeout if the VCG gets stuck; the responses
+        of such a batch shouldn't be trusted.
+        """
+        assert 0 < len(patterns) <= self.n_patterns
+
+        self.load_patterns(patterns)
+        self.set_intensity_level(intensity)
+
+        self.vcg.evcg_set_arm(True)
+        try:
+            for _ in patterns:
+                self.ser.write(STARTBYTE)
+                t0 = time.time()
+                self.wait_busy(t0)          # timed per trigger, before the caller resets the board
+                yield self.read_response(expected)
+        finally:
+            self.vcg.evcg_set_arm(False)
+
+
+    def read_response(self, expected=None):
+        """Reads the board's response as it streams in.
+
+        Returns the response, or `None` (a RESET) as soon as the board
+        falls silent: if the first byte is late, or if there's a gap
+        between bytes. If `expected` is given, the response is classified
+        as NORMAL or JUSTRIGHT (from the first differing byte on) for
+        the latency statistics in `response_latency`; otherwise, full
+        responses are counted as NORMAL.
+        """
+        timeout, inter_byte_timeout = self.ser.timeout, self.ser.inter_byte_timeout
+        t0 = time.time()
+        outcome = "RESET"
+        try:
+            if self.first_byte_max is None:
+                self.ser.timeout = TIMEOUT
+            else:
+                self.ser.timeout = min(TIMEOUT, max(FIRST_BYTE_MIN, FIRST_BYTE_SLACK*self.first_byte_max))
+            response = self.ser.read(1)
+            if not response:
+                return None
+            first_byte = time.time() - t0
+
+            self.ser.timeout = TIMEOUT
+            self.ser.inter_byte_timeout = INTERBYTE_TIMEOUT
+            diverged = expected is not None and response != expected[:1]
+            while len(response) < RESPLEN:
+                size = min(CHUNK, RESPLEN - len(response))
+                chunk = self.ser.read(size)
+                if len(chunk) < size:           # the board fell silent
+                    return None
+                if not diverged and expected is not None:
+                    diverged = chunk != expected[len(response) : len(response)+len(chunk)]
+                response += chunk
+
+            outcome = "JUSTRIGHT" if diverged else "NORMAL"
+            self.first_byte_max = max(self.first_byte_max or 0.0, first_byte)
+            return response
+
+        finally:
+            self.ser.timeout, self.ser.inter_byte_timeout = timeout, inter_byte_timeout
+            latency = self.response_latency[outcome]
+            dt = time.time() - t0
+            latency[0] += 1
+            latency[1] += dt
+            latency[2] = max(latency[2], dt)
+
+
+    def load_patterns(self, patterns):
+        """Commits the (offset, repetitions) `patterns` into the VCG,
+        unless they're the ones committed already."""
+        patterns = [(offset, 40//2, repeat) for offset, repeat in patterns]   # duration must be 40ns
+        if self.cache_state and patterns == self.committed_patterns:
+            self.skipped_uploads += 1
+            return
+
+        # flush any uncommited pattern sequences
+        self.vcg.evcg_clear_pattern()
 
+        # It's possible to add up to n_pattern glitch-patterns:
+        for pattern in patterns:
+            self.vcg.evcg_add_glitch(*pattern)
+        self.vcg.evcg_set_pattern()        # commits patterns into VCG
+        self.committed_patterns = patterns
+
+
+    def wait_busy(self, t0=None):
+        """Returns when the VCG is done glitching; `t0` is when it was triggered.
+
+        Instead of spinning on evcg_busy(), we follow `busy_schedule`,
+        and record how long it took.
+        """
         # NOTE:
         #  evcg_busy() might get stuck always returning True
-        t0 = time.time()
+        if t0 is None:
+            t0 = time.time()
+        first_poll, interval, stuck_after = self.busy_schedule
+
+        delay = t0 + first_poll - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        polled = time.time()
+        first = True
         while(self.vcg.evcg_busy()):
-            if time.time()-t0 > 0.5:
+            first = False
+            if time.time()-t0 > stuck_after:
                 global EVCG_TIMEOUT_COUNTER
                 EVCG_TIMEOUT_COUNTER += 1
                 self.vcg.evcg_set_arm(False)           # disarm, just in case
+                self.committed_patterns = self.committed_amplitude = None   # don't trust the device state
                 raise VCG_BusyTimeout("VCG stuck busy")
-            pass                        # waits until glitching finishes
-        self.vcg.evcg_set_arm(False)    # disarms the VCG
+            time.sleep(interval)
+            polled = time.time()
 
-        response = self.ser.read(RESPLEN)
-        if len(response) != RESPLEN:
-            raise VCG_ReadTimeout("board not responding")
+        self.record_busy(0.0 if first else polled - t0)
 
-        return response
+
+    def record_busy(self, duration):
+        """Adds a busy duration to the statistics (0 if it's only known to be
+        over by the first poll); every BUSY_MIN_SAMPLES durations, the
+        polling schedule is re-learned from them."""
+        self.busy_times.append(duration)
+        self.busy_histogram[np.searchsorted(BUSY_BINS, duration)] += 1
+
+        if len(self.busy_times) >= BUSY_MIN_SAMPLES and self.busy_histogram.sum() % BUSY_MIN_SAMPLES == 0:
+            p10, p50, p90 = np.percentile(self.busy_times, [10, 50, 90])
+            interval = min(max(BUSY_POLL_FRACTION*(p90-p10), BUSY_POLL_MIN), BUSY_POLL_MAX)
+            stuck_after = min(max(BUSY_STUCK_FACTOR*max(self.busy_times), BUSY_STUCK_MIN), BUSY_TIMEOUT)
+            recent = np.percentile(list(self.busy_times)[-BUSY_MIN_SAMPLES:], 10)
+            first_poll = max(recent, BUSY_BACKOFF*self.busy_schedule[0])
+            self.busy_schedule = (float(first_poll), float(interval), float(stuck_after))
 
 
-    def reset(self, secs=0.1):
+    def reset(self, secs=None, ready_timeout=None):
+        """Holds the board in reset for `secs`, then waits until it's ready.
+
+        If the board announces itself with `boot_banner`, we return as soon
+        as that arrives, with `ready_timeout` as the upper bound;
+        otherwise we just sleep for `ready_timeout`.
+        Returns `False` if the banner didn't arrive in time.
+        """
+        if secs is None:          secs = self.reset_pulse
+        if ready_timeout is None: ready_timeout = self.reset_ready
+
         self.vcg.set_smartcard_soft_reset(0)
         time.sleep(secs)
+        self.ser.reset_input_buffer()       # drop whatever the old run was still sending
         self.vcg.set_smartcard_soft_reset(1)
 
-        time.sleep(0.01)
+        if not self.boot_banner:
+            time.sleep(ready_timeout)
+            return True
+
+        timeout = self.ser.timeout
+        self.ser.timeout = ready_timeout
+        try:
+            return self.ser.read_until(self.boot_banner).endswith(self.boot_banner)
+        finally:
+            self.ser.timeout = timeout
+
+
+    def calibrate_reset(self, expected_response,
+                        pulses=(0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1),
+                        readies=(0.0, 0.0005, 0.001, 0.002, 0.005, 0.01),
+                        trials=10, safety=2.0):
+        """Finds the shortest reset pulse and ready time that work
+        reliably on the attached board, and starts using them
+        (multiplied by `safety`, but never more than the defaults).
+
+        A pulse works if it interrupts a run that's sending its response,
+        and the board then answers a new run with `expected_response`.
+        The ready time is then found the same way, with that pulse.
+        Returns (pulse, ready), in seconds.
+        """
+        def works(pulse, ready):
+            for _ in range(trials):
+                self.ser.write(STARTBYTE)
+                self.ser.read(1)                   # the board is busy responding ...
+                if not self.reset(pulse, ready):   # ... and we cut it short
+                    return False
+                if self.ser.in_waiting:            # the old run is still going
+                    return False
+                self.ser.write(STARTBYTE)
+                if self.ser.read(RESPLEN) != expected_response:
+                    return False
+                self.reset(RESET_PULSE, RESET_READY)
+            return True
+
+        pulse = next((p for p in pulses if works(p, RESET_READY)), RESET_PULSE)
+        ready = next((r for r in readies if works(pulse, r)), RESET_READY)
+
+        self.reset_pulse = min(pulse*safety, RESET_PULSE)
+        self.reset_ready = min(ready*safety, RESET_READY) if ready else 0.0
+        print("Reset pulse: {:.4f}s, ready after {:.4f}s".format(self.reset_pulse, self.reset_ready))
+        return self.reset_pulse, self.reset_ready
+
+    def read_reset_from_file(self, reset_file):
+        for line in reset_file:
+            line = line.strip()
+            if line:
+                pulse, ready = line.split(",")
+                self.reset_pulse, self.reset_ready = float(pulse), float(ready)
+
+    def write_reset_to_file(self, reset_file):
+        print("{!r},{!r}".format(self.reset_pulse, self.reset_ready), file=reset_file)
 
 
     def set_intensity_level(self, intensity):
         assert 0<=intensity<=1
-        HI = 4.2
-        LO = -9.8
-        self.vcg.set_laser_glitch_parameter(v_amplitude=(intensity*(HI-LO)+LO), v_vcc_clk=3.3)
+        amplitude = intensity*(AMPLITUDE_HI-AMPLITUDE_LO)+AMPLITUDE_LO
+        amplitude = round(amplitude/AMPLITUDE_STEP)*AMPLITUDE_STEP
+        if self.cache_state and amplitude == self.committed_amplitude:
+            self.skipped_uploads += 1
+            return
+        self.vcg.set_laser_glitch_parameter(v_amplitude=amplitude, v_vcc_clk=3.3)
+        self.committed_amplitude = amplitude
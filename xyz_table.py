@@ -88,6 +88,7 @@ class Reply(object):
 class Request(object):
     def __init__(self, cmd, type, axis, value):
 
+        self.cmd = cmd
         self.cmdHex = hex(cmd.value)[2:].zfill(2)
         self.typeHex = hex(type)[2:].zfill(2)
         self.axisHex = hex(axis.value)[2:].zfill(2)
@@ -103,6 +104,43 @@ class Request(object):
         return bytes_fromhex(self.as_hex())
 
 
+class Transport(object):
+    """Pipelined TMCL transport.
+
+    Requests are queued with `submit`; `flush` writes all of them out in a
+    single `ser.write`, then reads all the replies in one go and matches
+    them to the requests (the module answers in order).
+    """
+    REPLY_LEN = 9
+
+    def __init__(self, ser):
+        self.ser = ser
+        self.pending = []
+
+    def submit(self, request):
+        self.pending.append(request)
+
+    def flush(self):
+        """Sends the queued requests, returns their Replies (in the same order)."""
+        requests, self.pending = self.pending, []
+        if not requests:
+            return []
+
+        self.ser.write(b"".join(req.as_bytes() for req in requests))
+        raw = self.ser.read(self.REPLY_LEN * len(requests))
+        if len(raw) != self.REPLY_LEN * len(requests):
+            raise Exception("Expected {} replies, got {} bytes".format(len(requests), len(raw)))
+
+        replies = []
+        for i, req in enumerate(requests):
+            reply = Reply(raw[i*self.REPLY_LEN : (i+1)*self.REPLY_LEN])
+            if reply.cmd_number != req.cmd.value:
+                raise Exception("Reply to command {} doesn't match request {}".format(
+                                reply.cmd_number, req.cmd.name))
+            replies.append(reply)
+        return replies
+
+
 class XYTable:
 
     ser = serial.Serial()
@@ -115,6 +153,14 @@ class XYTable:
     ypoint = None    # SE corner
     # These must be set
 
+    # Calibrated `motion.MotionModel`, if any; used for path planning
+    motion_model = None
+
+    # The last commanded move, as remembered by `move_to_position`
+    last_target       = None
+    moved_axes        = None
+    predicted_arrival = None
+
     directions = {
         "left"     : (Axis.x, Command.ROR),   # -x
         "right"    : (Axis.x, Command.ROL),   # +x
@@ -124,7 +170,13 @@ class XYTable:
         "down"     : (Axis.z, Command.ROL)    # -z
     }
 
-    def __init__(self, points_file=None):
+    def __init__(self, points_file=None, ser=None, trace=None):
+        if ser is not None:         # e.g. a simulated port
+            self.ser = ser
+        if trace is not None:       # a `serial_trace.SerialTrace` to log the traffic into
+            from serial_trace import TracedSerial
+            self.ser = TracedSerial(self.ser, trace, "table")
+        self.transport = Transport(self.ser)
         if points_file:
             self.read_from_file(points_file)
 
@@ -192,18 +244,24 @@ class XYTable:
             return True
 
     def action(self, cmd, type, axis, value):
+        return self.actions([(cmd, type, axis, value)])[0]
 
-        req = Request(cmd, type, axis, value)
-        self.ser.write(req.as_bytes())
-        reply = Reply(self.ser.read(9))
+    def actions(self, commands):
+        """Sends a batch of (cmd, type, axis, value) commands at once.
+        Returns the reply values, in order.
+        """
+        for cmd, type, axis, value in commands:
+            self.transport.submit(Request(cmd, type, axis, value))
+        replies = self.transport.flush()
 
-        assert reply.ok, "Action failed!"
-        return reply.value
+        assert all(reply.ok for reply in replies), "Action failed!"
+        return [reply.value for reply in replies]
 
     def move(self, direction, speed=10000, stop=False, sleeptime=1):
         if direction not in self.directions:
             raise Exception("{} is not a valid direction".format(direction))
         axis, cmd = self.directions[direction]
+        self.last_target = None         # we no longer know where we're headed
 
         self.action(cmd, 0, axis, value=speed)
         if stop:
@@ -211,33 +269,64 @@ class XYTable:
             self.action(Command.MST, 0, axis, 0)
 
     def move_to_position(self, position):
-        self.action(Command.MVP, 0, Axis.x, position.x)
-        self.action(Command.MVP, 0, Axis.y, position.y)
-        self.action(Command.MVP, 0, Axis.z, position.z)
+        self.actions([(Command.MVP, 0, Axis.x, position.x),
+                      (Command.MVP, 0, Axis.y, position.y),
+                      (Command.MVP, 0, Axis.z, position.z)])
+
+        # remember the move, so that `wait` can predict the arrival
+        last = self.last_target
+        self.moved_axes = [axis for axis in (Axis.x, Axis.y, Axis.z)
+                           if last is None or getattr(last, axis.name) != getattr(position, axis.name)]
+        if last is not None and self.motion_model:
+            self.predicted_arrival = time.time() + self.motion_model.travel_time(last, position)
+        else:
+            self.predicted_arrival = None
+        self.last_target = position
 
     def get_position(self):
         """Returns the current position, in absolute coordinates"""
-        xpos = self.action(Command.GAP, AxisParameter.actual_pos.value, Axis.x, 0)
-        ypos = self.action(Command.GAP, AxisParameter.actual_pos.value, Axis.y, 0)
-        zpos = self.action(Command.GAP, AxisParameter.actual_pos.value, Axis.z, 0)
+        xpos, ypos, zpos = self.actions([
+                (Command.GAP, AxisParameter.actual_pos.value, axis, 0) for axis in (Axis.x, Axis.y, Axis.z)])
         return Point(xpos, ypos, zpos)
 
-    def wait(self):
-        """Returns when target position has been reached"""
+    def wait(self, predictive=True, margin=0.02, min_interval=0.002, max_interval=0.05):
+        """Returns when target position has been reached
+
+        If `predictive`, we sleep until `margin` seconds before the arrival
+        predicted by the motion model (if there is one), then poll only the
+        axes that were moved, backing off from `min_interval` up to
+        `max_interval` seconds between the polls.
+        Otherwise, all axes are polled back-to-back.
+        """
+        if not predictive:
+            while True:
+                stops = self.actions([
+                    (Command.GAP, AxisParameter.pos_reached.value, axis, 0) for axis in (Axis.x, Axis.y, Axis.z)])
+                if all(stops):
+                    return
+
+        if self.predicted_arrival is not None:
+            early = self.predicted_arrival - margin - time.time()
+            if early > 0:
+                time.sleep(early)
+
+        axes = self.moved_axes or [Axis.x, Axis.y, Axis.z]
+        interval = min_interval
         while True:
-            xstop = self.action(Command.GAP, AxisParameter.pos_reached.value, Axis.x, 0)
-            ystop = self.action(Command.GAP, AxisParameter.pos_reached.value, Axis.y, 0)
-            zstop = self.action(Command.GAP, AxisParameter.pos_reached.value, Axis.z, 0)
-            if xstop and ystop and zstop:
+            stops = self.actions([(Command.GAP, AxisParameter.pos_reached.value, axis, 0) for axis in axes])
+            axes = [axis for axis, stop in zip(axes, stops) if not stop]
+            if not axes:
                 return
+            time.sleep(interval)
+            interval = min(interval*1.5, max_interval)
             
     def stop(self, direction=None):
+        self.last_target = None
         if direction:
             axis = self.directions[direction][0]
             self.action(Command.MST, 0, axis, 0)
         else:
-            for axis in Axis:
-                self.action(Command.MST, 0, axis, 0)
+            self.actions([(Command.MST, 0, axis, 0) for axis in Axis])
             #print("Stopped.")
 
     def read_from_file(self, points_file):